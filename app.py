@@ -1,6 +1,5 @@
 import io
-import json
-import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Optional, List, Tuple
@@ -9,9 +8,9 @@ import pandas as pd
 import streamlit as st
 
 # Import your existing pipeline pieces
-from stage1_extract_text import (extract_text,clean_layout_text_for_ai)
+from stage1_extract_text import (extract_text,clean_layout_text_for_ai,pdf_page_count)
 from stage1b_redact_trim import redact, trim_invoice_text, trim_ead_text
-from stage2b_ai_extract_openai import ai_extract_invoice, ai_extract_ead
+from stage2b_ai_extract_openai import ai_extract_both, ai_extract_pair
 from stage3_match_validate_excel import (
     normalize_invoice_rows,
     normalize_ead_rows,
@@ -19,9 +18,14 @@ from stage3_match_validate_excel import (
     validate_shipment,
     validate_lines,
     build_output_df,
-    build_customs_excel
+    build_customs_excel,
+    issues_json_bytes,
 )
 
+# Uploads beyond these limits are rejected before any parsing / API spend
+MAX_UPLOAD_MB = 20
+MAX_PDF_PAGES = 60
+
 @dataclass
 class JobResult:
     job_id: str
@@ -32,55 +36,54 @@ class JobResult:
     excel_bytes: Optional[bytes] = None
     issues_bytes: Optional[bytes] = None
 
-def run_one_job(invoice_pdf_bytes: bytes, ead_pdf_bytes: bytes, model: str) -> Tuple[pd.DataFrame, List[dict], bytes, bytes]:
+def run_one_job(invoice_pdf_bytes: bytes, ead_pdf_bytes: bytes, model: str, single_request: bool = False) -> Tuple[pd.DataFrame, List[dict], bytes, bytes]:
     """
     Runs one invoice+EAD through:
     PDF->text -> redact/trim -> AI extract -> normalize -> match -> validate -> excel bytes + issues bytes
     Returns: output_df, issues_list, excel_file_bytes, issues_json_bytes
     """
-    with tempfile.TemporaryDirectory() as td:
-        td_path = Path(td)
-        inv_path = td_path / "invoice.pdf"
-        ead_path = td_path / "ead.pdf"
-        inv_path.write_bytes(invoice_pdf_bytes)
-        ead_path.write_bytes(ead_pdf_bytes)
+    # Both page limits are checked before either document is extracted
+    for kind, pdf_bytes in (("Invoice", invoice_pdf_bytes), ("EAD", ead_pdf_bytes)):
+        n_pages = pdf_page_count(pdf_bytes)
+        if n_pages > MAX_PDF_PAGES:
+            raise ValueError(f"{kind} PDF has {n_pages} pages (limit {MAX_PDF_PAGES})")
 
-        invoice_text = extract_text(str(inv_path),layout=False)
-        ead_text_raw = extract_text(str(ead_path),layout=True)
-        ead_text = clean_layout_text_for_ai(ead_text_raw)
+    # Jobs run on the app's thread pool: extract in-thread, no process pool
+    invoice_text = extract_text(invoice_pdf_bytes,layout=False,parallel=False)
+    ead_text = extract_text(ead_pdf_bytes,layout=True,transform=clean_layout_text_for_ai,parallel=False)
 
-        inv_safe = trim_invoice_text(redact(invoice_text))
-        ead_safe = trim_ead_text(redact(ead_text))
+    inv_safe = trim_invoice_text(redact(invoice_text))
+    ead_safe = trim_ead_text(redact(ead_text))
 
-        inv_ai = ai_extract_invoice(inv_safe, model=model)
-        ead_ai = ai_extract_ead(ead_safe, model=model)
+    extract = ai_extract_both if single_request else ai_extract_pair
+    inv_ai, ead_ai = extract(inv_safe, ead_safe, model=model)
 
-        inv = normalize_invoice_rows(inv_ai)
-        ead = normalize_ead_rows(ead_ai)
+    inv = normalize_invoice_rows(inv_ai)
+    ead = normalize_ead_rows(ead_ai)
 
-        shipment_issues = validate_shipment(
+    shipment_issues = validate_shipment(
         inv_ai, ead_ai, inv["lines"], ead["lines"],
         invoice_text=invoice_text, ead_text=ead_text
     )
 
-        # Matching + line-level checks
-        matches = match_invoice_to_ead(inv["lines"], ead["lines"])
-        line_issues = validate_lines(matches)
+    # Matching + line-level checks
+    matches = match_invoice_to_ead(inv["lines"], ead["lines"])
+    line_issues = validate_lines(matches)
 
-        issues = shipment_issues + line_issues
+    issues = shipment_issues + line_issues
 
-        df = build_output_df(matches)
+    df = build_output_df(matches)
 
-        excel_bytes = build_customs_excel(
+    excel_bytes = build_customs_excel(
         matches,
         template_path=Path(__file__).parent / "Packing List template.xlsx",
         inv_ai=inv_ai,
-        ead_text=ead_text
-        )
+        ead_text=ead_text,
+        df=df,
+    )
 
 
-        issues_json_bytes = json.dumps(issues, indent=2).encode("utf-8")
-        return df, issues, excel_bytes, issues_json_bytes
+    return df, issues, excel_bytes, issues_json_bytes(issues)
 
 def status_from_issues(issues: List[dict]) -> str:
     if not issues:
@@ -90,6 +93,19 @@ def status_from_issues(issues: List[dict]) -> str:
         return "FAIL"
     return "WARN"
 
+def summary_df(results: List[JobResult]) -> pd.DataFrame:
+    rows = []
+    for r in results:
+        emoji = {"OK": "✅", "WARN": "⚠️", "FAIL": "❌"}.get(r.status, "❓")
+        rows.append({
+            "Job": r.job_id,
+            "Status": f"{emoji} {r.status}",
+            "Issues": r.issues_count,
+            "Invoice": r.invoice_name,
+            "EAD": r.ead_name,
+        })
+    return pd.DataFrame(rows)
+
 st.set_page_config(page_title="Bacan Packing List Generator", layout="wide")
 st.title("Bacan — Invoice + EAD → Packing List")
 
@@ -100,8 +116,12 @@ st.markdown(
 # Sidebar config
 with st.sidebar:
     st.header("Settings")
-    model = st.selectbox("OpenAI model", ["gpt-4o"], index=0)
+    model = st.selectbox("OpenAI model", ["gpt-4o", "gpt-4o-mini"], index=0)
     st.caption("gpt-4o is the best option, gpt-4o-mini struggles with accuracys.")
+    single_request = st.checkbox("One AI request per pair", value=False)
+    st.caption("Extracts invoice + EAD in a single call: fewer requests and cheaper, slightly less robust on long documents.")
+    max_workers = st.slider("Parallel jobs", min_value=1, max_value=16, value=8)
+    st.caption("Pairs processed at the same time. Lower it if you hit OpenAI rate limits.")
 
 st.subheader("1) Upload files (bulk)")
 
@@ -130,22 +150,40 @@ if run_btn:
     if len(inv_sorted) != len(ead_sorted):
         st.warning(f"Counts differ: {len(inv_sorted)} invoices vs {len(ead_sorted)} EADs. Running first {n} pairs only.")
 
-    progress = st.progress(0)
+    jobs = []
     for i in range(n):
-        inv_file = inv_sorted[i]
-        ead_file = ead_sorted[i]
         job_id = f"JOB-{i+1:03d}"
+        too_big = [f.name for f in (inv_sorted[i], ead_sorted[i]) if f.size > MAX_UPLOAD_MB * 1024 * 1024]
+        if too_big:
+            st.error(f"{job_id} skipped: {', '.join(too_big)} larger than {MAX_UPLOAD_MB} MB.")
+            continue
+        jobs.append((job_id, inv_sorted[i], ead_sorted[i]))
+    n = len(jobs)
 
-        with st.spinner(f"{job_id}: Processing {inv_file.name} + {ead_file.name} ..."):
-            try:
-                df, issues, excel_bytes, issues_bytes = run_one_job(
+    progress = st.progress(0)
+    live_summary = st.empty()
+    results = {}
+
+    # Jobs are dominated by OpenAI latency, so run them on a thread pool.
+    # UI updates (progress, results) stay on the main script thread.
+    with st.spinner(f"Processing {n} pair(s), up to {max_workers} at a time ..."):
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            futures = {
+                ex.submit(
+                    run_one_job,
                     invoice_pdf_bytes=inv_file.getvalue(),
                     ead_pdf_bytes=ead_file.getvalue(),
                     model=model,
-                )
-                status = status_from_issues(issues)
-                st.session_state.results.append(
-                    JobResult(
+                    single_request=single_request,
+                ): (job_id, inv_file, ead_file)
+                for job_id, inv_file, ead_file in jobs
+            }
+            for done, fut in enumerate(as_completed(futures), start=1):
+                job_id, inv_file, ead_file = futures[fut]
+                try:
+                    df, issues, excel_bytes, issues_bytes = fut.result()
+                    status = status_from_issues(issues)
+                    results[job_id] = JobResult(
                         job_id=job_id,
                         invoice_name=inv_file.name,
                         ead_name=ead_file.name,
@@ -154,10 +192,9 @@ if run_btn:
                         excel_bytes=excel_bytes,
                         issues_bytes=issues_bytes,
                     )
-                )
-            except Exception as e:
-                st.session_state.results.append(
-                    JobResult(
+                except Exception as e:
+                    st.error(f"{job_id} failed: {e}")
+                    results[job_id] = JobResult(
                         job_id=job_id,
                         invoice_name=inv_file.name,
                         ead_name=ead_file.name,
@@ -166,26 +203,30 @@ if run_btn:
                         excel_bytes=None,
                         issues_bytes=str(e).encode("utf-8"),
                     )
+
+                progress.progress(done / n)
+                # Show finished jobs (in upload order) while the rest run
+                live_summary.dataframe(
+                    summary_df([results[j] for j, _, _ in jobs if j in results]),
+                    use_container_width=True,
                 )
 
-        progress.progress((i + 1) / n)
+    live_summary.empty()
+    # Keep the summary in upload order regardless of completion order
+    st.session_state.results = [results[job_id] for job_id, _, _ in jobs]
 
 st.subheader("2) Results")
 
-if st.session_state.results:
+# Fragment: download clicks rerun only this section, not the whole page
+# (uploaders, settings, and the job loop guard).
+@st.fragment
+def render_results():
+    if not st.session_state.results:
+        st.caption("No runs yet. Upload files and click **Generate Packing Lists**.")
+        return
+
     # Summary table
-    summary_rows = []
-    for r in st.session_state.results:
-        emoji = {"OK": "✅", "WARN": "⚠️", "FAIL": "❌"}.get(r.status, "❓")
-        summary_rows.append({
-            "Job": r.job_id,
-            "Status": f"{emoji} {r.status}",
-            "Issues": r.issues_count,
-            "Invoice": r.invoice_name,
-            "EAD": r.ead_name,
-        })
-    summary_df = pd.DataFrame(summary_rows)
-    st.dataframe(summary_df, use_container_width=True)
+    st.dataframe(summary_df(st.session_state.results), use_container_width=True)
 
     st.subheader("3) Download")
     for r in st.session_state.results:
@@ -204,5 +245,5 @@ if st.session_state.results:
                     file_name=f"{r.job_id}_issues.json",
                     mime="application/json",
                 )
-else:
-    st.caption("No runs yet. Upload files and click **Generate Packing Lists**.")
+
+render_results()
@@ -5,27 +5,69 @@ EMAIL_RE = re.compile(r"\b[\w\.-]+@[\w\.-]+\.\w+\b", re.IGNORECASE)
 IBAN_RE  = re.compile(r"\b[A-Z]{2}\d{2}[A-Z0-9]{10,30}\b")
 BIC_RE   = re.compile(r"\b[A-Z]{6}[A-Z0-9]{2}([A-Z0-9]{3})?\b")
 
+# All three in one scan, sharing the leading word boundary. Alternation order
+# keeps the old precedence (email, then IBAN, then BIC). EMAIL_RE's
+# IGNORECASE is a no-op for its \w-based classes, so the combined pattern
+# stays case-sensitive as IBAN/BIC require.
+PII_RE = re.compile(
+    r"\b(?:(?P<EMAIL>[\w\.-]+@[\w\.-]+\.\w+\b)"
+    r"|(?P<IBAN>[A-Z]{2}\d{2}[A-Z0-9]{10,30}\b)"
+    r"|(?P<BIC>[A-Z]{6}[A-Z0-9]{2}(?:[A-Z0-9]{3})?\b))"
+)
+
+# Likely starts of the invoice product table, in priority order: the first
+# anchor present anywhere wins (not the earliest position). A handful of
+# str.find calls beats a regex alternation here, since the top anchors
+# usually hit within the first ~1k chars.
+INVOICE_TABLE_ANCHORS = (
+    "Codice Descrizione", "Descrizione", "U.M.", "Quantità", "BT",
+    "Nomenclatura", "Lotto", "Lot", "HS", "CN", "Commodity",
+)
+
+def _redact_match(m: re.Match) -> str:
+    return f"[{m.lastgroup}_REDACTED]"
+
 def redact(text: str) -> str:
-    text = EMAIL_RE.sub("[EMAIL_REDACTED]", text)
-    text = IBAN_RE.sub("[IBAN_REDACTED]", text)
-    text = BIC_RE.sub("[BIC_REDACTED]", text)
-    return text
+    return PII_RE.sub(_redact_match, text)
+
+# Start of the EAD "(17) DETTAGLI DEL DAA" product block. Only its position is
+# needed: the body is sliced from there, no ".*" match over the rest of the text.
+EAD_DETAILS_RE = re.compile(r"\(17\)\s+DETTAGLI DEL DAA")
+
+# Pure rule lines ("-----", "=====", "_____") carry no data for the model
+SEPARATOR_LINE_RE = re.compile(r"[-=_]{3,}")
+
+def compact_text(text: str) -> str:
+    """
+    Token-saving cleanup before trimming: drops rule-only lines and trailing
+    whitespace, and collapses runs of blank lines to one. Every other line is
+    kept, repeated ones included: identical consecutive rows can be separate
+    product lines of the same wine.
+    """
+    out = []
+    prev_blank = False
+    for line in text.splitlines():
+        line = line.rstrip()
+        if SEPARATOR_LINE_RE.fullmatch(line.lstrip()):
+            continue
+        blank = not line
+        if blank and prev_blank:
+            continue
+        out.append(line)
+        prev_blank = blank
+    return "\n".join(out)
 
 def trim_invoice_text(text: str, max_chars: int = 12000) -> str:
     """
     Keep a small header + the product/table region. Works across languages better than
     sending the whole PDF (cheaper + safer).
     """
-    t = text
+    t = compact_text(text)
     header = t[:2000]
 
     # find a likely start of product lines/table
-    anchors = [
-        "Codice Descrizione", "Descrizione", "U.M.", "Quantità", "BT",
-        "Nomenclatura", "Lotto", "Lot", "HS", "CN", "Commodity"
-    ]
     start = None
-    for a in anchors:
+    for a in INVOICE_TABLE_ANCHORS:
         idx = t.find(a)
         if idx != -1:
             start = idx
@@ -39,11 +81,11 @@ def trim_ead_text(text: str, max_chars: int = 12000) -> str:
     """
     Keep header + the (17) excise product lines (the important part for matching).
     """
-    t = text
+    t = compact_text(text)
     header = t[:3500]
 
-    m = re.search(r"\(17\)\s+DETTAGLI DEL DAA.*", t, flags=re.DOTALL)
-    body = (m.group(0)[:9000] if m else t[3500:12500])
+    m = EAD_DETAILS_RE.search(t)
+    body = (t[m.start():m.start() + 9000] if m else t[3500:12500])
 
     merged = header + "\n\n--- TRIMMED (17) BLOCK ---\n\n" + body
     return merged[:max_chars]
@@ -2,37 +2,71 @@ import re
 from dataclasses import dataclass, asdict
 from typing import List, Optional, Dict
 
+# Header
+ARC_RE = re.compile(r"\(1\.d\)\s*ARC:\s*([A-Z0-9]+)")
+INVOICE_NO_RE = re.compile(r"\(9\.b\)\s*Numero della fattura:\s*([0-9]+/[0-9]+)")
+INVOICE_DATE_RE = re.compile(r"\(9\.c\)\s*Data della fattura:\s*([0-9]{2}/[0-9]{2}/[0-9]{4})")
+
+# Block markers: "(17) DETTAGLI DEL DAA - PROGRESSIVO N. X" / "(17.1) IMBALLAGGI - PROGRESSIVO N. X"
+PROD_SPLIT_RE = re.compile(r"\(17\)\s*DETTAGLI DEL DAA - PROGRESSIVO N\.\s*")
+PACK_SPLIT_RE = re.compile(r"\(17\.1\)\s*IMBALLAGGI - PROGRESSIVO N\.\s*")
+PROG_RE = re.compile(r"(\d+)")
+
+# Product block fields
+CN_RE = re.compile(r"Codice NC:\s*([0-9]{6,10})")
+ABV_RE = re.compile(r"Titolo alcolometrico:\s*([0-9]+(?:\.[0-9]+)?)")
+LITERS_RE = re.compile(r"Quantità\s*\(Lt\.\s*a\s*20°\):\s*([0-9]+(?:\.[0-9]+)?)")
+GROSS_RE = re.compile(r"Massa lorda\s*\(Kg\):\s*([0-9]+(?:\.[0-9]+)?)")
+NET_RE = re.compile(r"Massa netta\s*\(Kg\):\s*([0-9]+(?:\.[0-9]+)?)")
+DESIG_RE = re.compile(r"\(17\.\d+\.p\)\s*Designazione\s+(.+)")
+
+# Packaging block fields
+CASES_RE = re.compile(r"Numero di colli:\s*(\d+)")
+
+
+def _block_spans(marker_re: re.Pattern, text: str) -> List[tuple]:
+    """
+    (start, end) offsets of the text after each block marker up to the next
+    one: the pieces marker_re.split(text)[1:] would return, without copying
+    them. Field regexes then search text[start:end] via pos/endpos.
+    """
+    markers = list(marker_re.finditer(text))
+    return [
+        (m.end(), markers[i + 1].start() if i + 1 < len(markers) else len(text))
+        for i, m in enumerate(markers)
+    ]
+
 
 def _to_float(x: Optional[str]) -> Optional[float]:
     if x is None:
         return None
-    return float(x.strip())
+    return float(x)  # regex groups carry no whitespace; float() would ignore it anyway
 
 
 def parse_ead(ead_text: str) -> Dict:
     # Header
-    arc = re.search(r"\(1\.d\)\s*ARC:\s*([A-Z0-9]+)", ead_text)
-    invoice_no = re.search(r"\(9\.b\)\s*Numero della fattura:\s*([0-9]+/[0-9]+)", ead_text)
-    invoice_date = re.search(r"\(9\.c\)\s*Data della fattura:\s*([0-9]{2}/[0-9]{2}/[0-9]{4})", ead_text)
+    arc = ARC_RE.search(ead_text)
+    invoice_no = INVOICE_NO_RE.search(ead_text)
+    invoice_date = INVOICE_DATE_RE.search(ead_text)
 
     # Product blocks: "(17) DETTAGLI DEL DAA - PROGRESSIVO N. X"
-    prod_blocks = re.split(r"\(17\)\s*DETTAGLI DEL DAA - PROGRESSIVO N\.\s*", ead_text)
     products = []
 
-    for b in prod_blocks[1:]:
-        # progressivo is first token in the block
-        m_prog = re.match(r"(\d+)", b.strip())
+    for start, end in _block_spans(PROD_SPLIT_RE, ead_text):
+        # progressivo is first token in the block (the marker regex already
+        # consumed the whitespace before it)
+        m_prog = PROG_RE.match(ead_text, start, end)
         if not m_prog:
             continue
         prog = int(m_prog.group(1))
 
-        cn = re.search(r"Codice NC:\s*([0-9]{6,10})", b)
-        abv = re.search(r"Titolo alcolometrico:\s*([0-9]+(?:\.[0-9]+)?)", b)
-        liters = re.search(r"Quantità\s*\(Lt\.\s*a\s*20°\):\s*([0-9]+(?:\.[0-9]+)?)", b)
-        gross = re.search(r"Massa lorda\s*\(Kg\):\s*([0-9]+(?:\.[0-9]+)?)", b)
-        net = re.search(r"Massa netta\s*\(Kg\):\s*([0-9]+(?:\.[0-9]+)?)", b)
+        cn = CN_RE.search(ead_text, start, end)
+        abv = ABV_RE.search(ead_text, start, end)
+        liters = LITERS_RE.search(ead_text, start, end)
+        gross = GROSS_RE.search(ead_text, start, end)
+        net = NET_RE.search(ead_text, start, end)
         # Capture the "Designazione ..." text that appears after "(17.x.p) Designazione"
-        designation = re.search(r"\(17\.\d+\.p\)\s*Designazione\s+(.+)", b)
+        designation = DESIG_RE.search(ead_text, start, end)
 
         products.append({
             "progressivo": prog,
@@ -46,14 +80,13 @@ def parse_ead(ead_text: str) -> Dict:
         })
 
     # Packaging blocks: "(17.1) IMBALLAGGI - PROGRESSIVO N. X"
-    pack_blocks = re.split(r"\(17\.1\)\s*IMBALLAGGI - PROGRESSIVO N\.\s*", ead_text)
     prog_to_cases = {}
-    for pb in pack_blocks[1:]:
-        m_prog = re.match(r"(\d+)", pb.strip())
+    for start, end in _block_spans(PACK_SPLIT_RE, ead_text):
+        m_prog = PROG_RE.match(ead_text, start, end)
         if not m_prog:
             continue
         prog = int(m_prog.group(1))
-        m_cases = re.search(r"Numero di colli:\s*(\d+)", pb)
+        m_cases = CASES_RE.search(ead_text, start, end)
         if m_cases:
             prog_to_cases[prog] = int(m_cases.group(1))
 
@@ -1,10 +1,36 @@
 import re
 from typing import Dict, List, Optional
 
+# Header / totals
+INV_NO_DATE_RE = re.compile(r"\bEURO\s+([0-9]+/[0-9]+)\s+([0-9]{2}/[0-9]{2}/[0-9]{4})\b")
+TOTAL_CASES_RE = re.compile(r"Nr\.\s*(\d+)\s*crt da\s*(\d+)\s*bottiglie", re.IGNORECASE)
+GROSS_RE = re.compile(r"Peso Lordo Kg\.\s*([0-9\.,]+)", re.IGNORECASE)
+NET_RE = re.compile(r"peso netto kg\.\s*([0-9\.,]+)", re.IGNORECASE)
+ARC_RE = re.compile(r"\bArc\s*:\s*([A-Z0-9]+)", re.IGNORECASE)
+INCOTERM_RE = re.compile(r"Incoterms\s*=\s*([A-Z]{3})")
+
+# Line starts: CODE + YEAR + DESCRIPTION ... BT qty cases unitprice net ...
+LINE_RE = re.compile(
+    r"^(?P<code>[A-Z]{3,6}\s+\d{2})\s+"
+    r"(?P<desc>.+?)\s+BT\s+"
+    r"(?P<bottles>[0-9\.,]+)\s+"
+    r"(?P<cases>\d+)\s+"
+    r"(?P<price>[0-9\.,]+)\s+"
+    r"(?P<value>[0-9\.,]+)\s+\d+\s*$",
+    re.MULTILINE
+)
+
+# Per-line block fields
+CN_RE = re.compile(r"Nomenclatura\s*:\s*([0-9]{6,10})")
+LOT_RE = re.compile(r"Lotto\s+num\.?\s*([A-Z0-9\.]+)")
+ABV_RE = re.compile(r"GRADI\s*([0-9]+(?:,[0-9]+)?)%\s*VOL")
+BPC_RE = re.compile(r"CRT\s+DA\s+(\d+)\s+BTLS", re.IGNORECASE)
+CL_RE = re.compile(r"CL\.?(\d+)", re.IGNORECASE)
+
 
 def euro_to_float(s: str) -> float:
-    # "1.650,00" -> 1650.00
-    return float(s.replace(".", "").replace(",", ".").strip())
+    # "1.650,00" -> 1650.00 (float() ignores surrounding whitespace itself)
+    return float(s.replace(".", "").replace(",", "."))
 
 
 def qty_to_int(q: str) -> int:
@@ -14,48 +40,36 @@ def qty_to_int(q: str) -> int:
 
 def parse_invoice(invoice_text: str) -> Dict:
    # More robust: finds "... EURO 64/00 21/01/2026 ..."
-    m = re.search(r"\bEURO\s+([0-9]+/[0-9]+)\s+([0-9]{2}/[0-9]{2}/[0-9]{4})\b", invoice_text)
+    m = INV_NO_DATE_RE.search(invoice_text)
     inv_no = m.group(1) if m else None
     inv_date = m.group(2) if m else None
 
 
     # Total cases / gross / net are on page 2 in the narrative
     total_cases = None
-    m_cases = re.search(r"Nr\.\s*(\d+)\s*crt da\s*(\d+)\s*bottiglie", invoice_text, re.IGNORECASE)
+    m_cases = TOTAL_CASES_RE.search(invoice_text)
     if m_cases:
         total_cases = int(m_cases.group(1))
 
     gross_kg = None
     net_kg = None
-    m_gross = re.search(r"Peso Lordo Kg\.\s*([0-9\.,]+)", invoice_text, re.IGNORECASE)
-    m_net = re.search(r"peso netto kg\.\s*([0-9\.,]+)", invoice_text, re.IGNORECASE)
+    m_gross = GROSS_RE.search(invoice_text)
+    m_net = NET_RE.search(invoice_text)
     if m_gross:
         gross_kg = euro_to_float(m_gross.group(1))
     if m_net:
         net_kg = euro_to_float(m_net.group(1))
 
-    arc = re.search(r"\bArc\s*:\s*([A-Z0-9]+)", invoice_text, re.IGNORECASE)
-    incoterm = re.search(r"Incoterms\s*=\s*([A-Z]{3})", invoice_text)
+    arc = ARC_RE.search(invoice_text)
+    incoterm = INCOTERM_RE.search(invoice_text)
 
-    # Line starts: CODE + YEAR + DESCRIPTION ... BT qty cases unitprice net ...
     # Capture the whole line, then we’ll look ahead for GRADI/Nomenclatura/Lotto/packaging.
-    line_pattern = re.compile(
-    r"^(?P<code>[A-Z]{3,6}\s+\d{2})\s+"
-    r"(?P<desc>.+?)\s+BT\s+"
-    r"(?P<bottles>[0-9\.,]+)\s+"
-    r"(?P<cases>\d+)\s+"
-    r"(?P<price>[0-9\.,]+)\s+"
-    r"(?P<value>[0-9\.,]+)\s+\d+\s*$",
-    re.MULTILINE
-)
-
-    matches = list(line_pattern.finditer(invoice_text))
+    matches = list(LINE_RE.finditer(invoice_text))
 
     lines = []
     for i, m in enumerate(matches):
         start = m.start()
         end = matches[i + 1].start() if i + 1 < len(matches) else len(invoice_text)
-        block = invoice_text[start:end]
 
         code_year = m.group("code").strip()
         desc_head = m.group("desc").strip()
@@ -64,14 +78,15 @@ def parse_invoice(invoice_text: str) -> Dict:
         unit_price = euro_to_float(m.group("price"))
         value = euro_to_float(m.group("value"))
 
-        # CN / Lot / ABV / packaging inside the block
-        cn = re.search(r"Nomenclatura\s*:\s*([0-9]{6,10})", block)
-        lot = re.search(r"Lotto\s+num\.?\s*([A-Z0-9\.]+)", block)
-        abv = re.search(r"GRADI\s*([0-9]+(?:,[0-9]+)?)%\s*VOL", block)
+        # CN / Lot / ABV / packaging inside the block [start:end]; searched
+        # in place (pos/endpos) rather than on a sliced copy
+        cn = CN_RE.search(invoice_text, start, end)
+        lot = LOT_RE.search(invoice_text, start, end)
+        abv = ABV_RE.search(invoice_text, start, end)
 
         # bottles per case + bottle size (cl)
-        bpc = re.search(r"CRT\s+DA\s+(\d+)\s+BTLS", block, re.IGNORECASE)
-        cl = re.search(r"CL\.?(\d+)", block, re.IGNORECASE)
+        bpc = BPC_RE.search(invoice_text, start, end)
+        cl = CL_RE.search(invoice_text, start, end)
 
         bottles_per_case = int(bpc.group(1)) if bpc else None
         bottle_liters = (int(cl.group(1)) / 100.0) if cl else None
@@ -1,15 +1,168 @@
-from typing import List, Optional
-from pydantic import BaseModel
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from pathlib import Path
+from typing import List, Optional, Tuple
+from pydantic import BaseModel, ValidationError
 from openai import OpenAI
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+import httpx2
+import openai
 import streamlit as st
+import hashlib
+import importlib.util
+import json
+import logging
 import os
+import re
+import threading
+import time
+import unicodedata
+
+logger = logging.getLogger(__name__)
+
+# HTTP/2 lets concurrent requests share one TLS connection; it needs the
+# optional h2 package (httpx2[http2]), otherwise fall back to HTTP/1.1
+# keep-alive pooling.
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# Structured extraction of a long document can take well over a minute, so
+# the read timeout stays generous; connecting should never take long.
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "120"))
+OPENAI_CONNECT_TIMEOUT_SECONDS = float(os.getenv("OPENAI_CONNECT_TIMEOUT_SECONDS", "10"))
+
+# Retries belong to _retry_transient below. The SDK's own retries (2 by
+# default) would multiply its attempts and sleep while holding a request slot.
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "0"))
 
 def get_openai_client() -> OpenAI:
+    """
+    The one client shared by every extraction call and thread: its pooled
+    keep-alive (or HTTP/2) connections are reused across requests.
+    """
     api_key = st.secrets.get("OPENAI_API_KEY", os.getenv("OPENAI_API_KEY"))
-    return OpenAI(api_key=api_key)
+    http_client = openai.DefaultHttpxClient(
+        http2=HTTP2_AVAILABLE,
+        limits=httpx2.Limits(max_connections=64, max_keepalive_connections=32),
+        timeout=httpx2.Timeout(OPENAI_TIMEOUT_SECONDS, connect=OPENAI_CONNECT_TIMEOUT_SECONDS),
+    )
+    return OpenAI(api_key=api_key, http_client=http_client, max_retries=OPENAI_MAX_RETRIES)
 
 client = get_openai_client()
 
+# Upper bound on in-flight OpenAI requests across all worker threads, so bulk
+# runs stay under the account's RPM/TPM limits.
+MAX_CONCURRENT_REQUESTS = int(os.getenv("OPENAI_MAX_CONCURRENT_REQUESTS", "8"))
+_request_slots = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+
+# Transient API failures (429 / 5xx / network) are retried with jittered
+# exponential backoff instead of failing the whole job. The backoff sleep
+# happens outside the request semaphore, so it does not hold a slot.
+_retry_transient = retry(
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception_type((
+        openai.RateLimitError,
+        openai.APIConnectionError,
+        openai.APITimeoutError,
+        openai.InternalServerError,
+    )),
+    reraise=True,
+)
+
+# Identical (text, model) inputs are answered from Streamlit's data cache, so
+# rerunning unchanged jobs in the app does not call the API again. Applied
+# outside the retry/semaphore so cache hits never wait for a request slot.
+_cache_result = st.cache_data(show_spinner=False, max_entries=256, ttl=3600)
+
+# OpenAI caches prompt prefixes automatically (1024+ tokens). The static
+# part of each request (system prompt, response schema) is byte-identical
+# on every call and the document text comes last, so only the tail varies;
+# a per-prompt prompt_cache_key routes requests sharing that prefix to the
+# same cache.
+PROMPT_CACHE_KEY_PREFIX = os.getenv("OPENAI_PROMPT_CACHE_KEY_PREFIX", "bacan-stage2b")
+
+# Parsed responses are also kept on disk (one JSON file per request), so CLI
+# reruns and test_ai_extract.py on byte-identical safe text skip the API
+# entirely. Bump PROMPT_VERSION whenever SYSTEM / EAD_SYSTEM or the response
+# models change. AI_CACHE_DIR="" disables the cache; AI_CACHE_TTL (seconds,
+# 0 = never) expires entries by file mtime.
+PROMPT_VERSION = "1"
+AI_CACHE_DIR = os.getenv("AI_CACHE_DIR", ".cache/ai_extract")
+AI_CACHE_TTL = float(os.getenv("AI_CACHE_TTL", "0"))
+
+# Document text is canonicalized before it is hashed or sent, so texts that
+# differ only in Unicode composition, line endings or whitespace runs give
+# the same request: one disk-cache entry and a stable prompt tail. Line
+# breaks are kept (the models read table rows line by line).
+_HSPACE_RUN_RE = re.compile(r"[^\S\n]+")
+_BLANK_LINES_RE = re.compile(r"\n{3,}")
+
+def _canonicalize_safe_text(text: str) -> str:
+    text = unicodedata.normalize("NFC", text)
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    text = "\n".join(_HSPACE_RUN_RE.sub(" ", line).strip() for line in text.split("\n"))
+    return _BLANK_LINES_RE.sub("\n\n", text).strip()
+
+def _cache_path(kind: str, model: str, text: str) -> Optional[Path]:
+    """AI_CACHE_DIR/<sha256 of kind, model, PROMPT_VERSION, text>.json, or None if disabled."""
+    if not AI_CACHE_DIR:
+        return None
+    key = hashlib.sha256("\0".join((kind, model, PROMPT_VERSION, text)).encode("utf-8")).hexdigest()
+    return Path(AI_CACHE_DIR) / f"{key}.json"
+
+def _cache_load(path: Optional[Path], model_cls):
+    """Cached model_cls at path, or None if disabled / missing / stale / unreadable."""
+    if path is None:
+        return None
+    try:
+        if not AI_CACHE_TTL or time.time() - path.stat().st_mtime < AI_CACHE_TTL:
+            return model_cls.model_validate_json(path.read_bytes())
+    except (OSError, ValueError):  # pydantic's ValidationError is a ValueError
+        pass
+    return None
+
+def _cache_store(path: Optional[Path], result) -> None:
+    if path is None:
+        return
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_text(result.model_dump_json(), encoding="utf-8")
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.warning("could not write AI cache entry %s: %s", path, e)
+
+def _disk_cache(kind: str, model_cls):
+    """
+    Decorator for fn(text, model=...) -> model_cls: canonicalizes text, then
+    answers from the disk cache when present, otherwise calls fn and writes
+    its result there.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(text: str, model: str = "gpt-4o"):
+            text = _canonicalize_safe_text(text)
+            path = _cache_path(kind, model, text)
+            result = _cache_load(path, model_cls)
+            if result is None:
+                result = fn(text, model=model)
+                _cache_store(path, result)
+            return result
+        return wrapper
+    return decorator
+
+def _log_usage(kind: str, model: str, resp) -> None:
+    """
+    Log prompt/completion token counts reported by the API (for TPM sizing),
+    including how many input tokens were served from the prompt cache.
+    """
+    usage = getattr(resp, "usage", None)
+    if usage is not None:
+        cached = getattr(getattr(usage, "input_tokens_details", None), "cached_tokens", None)
+        logger.info("%s extraction [%s]: %s input (%s cached) / %s output tokens",
+                    kind, model, usage.input_tokens, cached or 0, usage.output_tokens)
+
 # Row shape designed to cover BOTH docs.
 # For invoice rows, weights/liters may be null.
 # For EAD rows, invoice_value/lot may be null.
@@ -60,6 +213,10 @@ class EADAI(BaseModel):
     ead_gross_kg: Optional[float] = None
     ead_net_kg: Optional[float] = None
 
+class InvoiceAndEAD(BaseModel):
+    invoice: InvoiceAI
+    ead: EADAI
+
 SYSTEM = """
 You are a customs logistics expert extracting structured product-line data for a Packing List.
 Input text can be in any language and any layout (tables, wrapped lines, page breaks).
@@ -141,30 +298,249 @@ Do not confuse "Numero progressivo" in the header with product progressivo.
 Do NOT guess. Use null when missing.
 """
 
+@_cache_result
+@_disk_cache("invoice", InvoiceAI)
+@_retry_transient
 def ai_extract_invoice(text: str, model: str = "gpt-4o") -> InvoiceAI:
-    resp = client.responses.parse(
-        model=model,
-        temperature=0,
-        top_p=1,
-        input=[
-            {"role": "system", "content": SYSTEM},
-            {"role": "user", "content": text},
-        ],
-        text_format=InvoiceAI,
-        store=False,
-    )
+    with _request_slots:
+        resp = client.responses.parse(
+            model=model,
+            temperature=0,
+            top_p=1,
+            input=[
+                {"role": "system", "content": SYSTEM},
+                {"role": "user", "content": text},
+            ],
+            text_format=InvoiceAI,
+            store=False,
+            prompt_cache_key=f"{PROMPT_CACHE_KEY_PREFIX}-invoice",
+        )
+    _log_usage("invoice", model, resp)
     return resp.output_parsed
 
+@_cache_result
+@_disk_cache("ead", EADAI)
+@_retry_transient
 def ai_extract_ead(text: str, model: str = "gpt-4o") -> EADAI:
-    resp = client.responses.parse(
-        model=model,
-        temperature=0,
-        top_p=1,
-        input=[
-            {"role": "system", "content": EAD_SYSTEM},
+    with _request_slots:
+        resp = client.responses.parse(
+            model=model,
+            temperature=0,
+            top_p=1,
+            input=[
+                {"role": "system", "content": EAD_SYSTEM},
+                {"role": "user", "content": text},
+            ],
+            text_format=EADAI,
+            store=False,
+            prompt_cache_key=f"{PROMPT_CACHE_KEY_PREFIX}-ead",
+        )
+    _log_usage("EAD", model, resp)
+    return resp.output_parsed
+
+def ai_extract_pair(invoice_text: str, ead_text: str, model: str = "gpt-4o") -> Tuple[InvoiceAI, EADAI]:
+    """
+    Runs the invoice and EAD extractions concurrently (they are independent),
+    so a job waits max(invoice, ead) instead of their sum.
+    """
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        inv_future = ex.submit(ai_extract_invoice, invoice_text, model=model)
+        ead_future = ex.submit(ai_extract_ead, ead_text, model=model)
+        return inv_future.result(), ead_future.result()
+
+BOTH_SYSTEM = f"""
+You receive two documents of the same shipment in one message: an INVOICE
+and its EAD / e-AD. Extract each one independently into its own object:
+"invoice" from the INVOICE section only, "ead" from the EAD section only.
+
+=== INVOICE INSTRUCTIONS ===
+{SYSTEM}
+=== EAD INSTRUCTIONS ===
+{EAD_SYSTEM}"""
+
+@_cache_result
+@_retry_transient
+def ai_extract_both(invoice_text: str, ead_text: str, model: str = "gpt-4o") -> Tuple[InvoiceAI, EADAI]:
+    """
+    Extracts invoice and EAD in ONE structured-output request (one round-trip
+    and one rate-limit slot per job instead of two). Same result shape as
+    ai_extract_pair.
+    """
+    invoice_text = _canonicalize_safe_text(invoice_text)
+    ead_text = _canonicalize_safe_text(ead_text)
+    with _request_slots:
+        resp = client.responses.parse(
+            model=model,
+            temperature=0,
+            top_p=1,
+            input=[
+                {"role": "system", "content": BOTH_SYSTEM},
+                {"role": "user", "content": (
+                    "=== INVOICE ===\n" + invoice_text + "\n\n=== EAD ===\n" + ead_text
+                )},
+            ],
+            text_format=InvoiceAndEAD,
+            store=False,
+            prompt_cache_key=f"{PROMPT_CACHE_KEY_PREFIX}-both",
+        )
+    _log_usage("invoice+EAD", model, resp)
+    both = resp.output_parsed
+    return both.invoice, both.ead
+
+# -----------------------------
+# Batch API (bulk / overnight runs)
+# -----------------------------
+# Many documents at once through the Batch API: half the token price and no
+# per-request round-trips, at up to 24h turnaround. Requests are the same
+# /v1/responses bodies ai_extract_invoice / ai_extract_ead send, and results
+# go through (and are served from) the same disk cache.
+BATCH_POLL_SECONDS = float(os.getenv("OPENAI_BATCH_POLL_SECONDS", "30"))
+BATCH_DONE = ("completed", "failed", "expired", "cancelled")
+
+def _strict_schema(node):
+    """
+    JSON schema made acceptable to strict structured outputs, in place: every
+    object lists all its properties as required and allows no others (the
+    Optional fields stay nullable), and null defaults are dropped.
+    """
+    if isinstance(node, dict):
+        if node.get("type") == "object":
+            node.setdefault("additionalProperties", False)
+        if isinstance(node.get("properties"), dict):
+            node["required"] = list(node["properties"])
+        if "default" in node and node["default"] is None:
+            del node["default"]
+        for value in node.values():
+            _strict_schema(value)
+    elif isinstance(node, list):
+        for value in node:
+            _strict_schema(value)
+    return node
+
+def _text_format(model_cls) -> dict:
+    """Strict json_schema text.format for model_cls, as responses.parse sends it."""
+    return {
+        "type": "json_schema",
+        "name": model_cls.__name__,
+        "schema": _strict_schema(model_cls.model_json_schema()),
+        "strict": True,
+    }
+
+def _batch_line(custom_id: str, system: str, text: str, text_format, model: str, kind: str) -> bytes:
+    body = {
+        "model": model,
+        "temperature": 0,
+        "top_p": 1,
+        "input": [
+            {"role": "system", "content": system},
             {"role": "user", "content": text},
         ],
-        text_format=EADAI,
-        store=False,
+        "text": {"format": _text_format(text_format)},
+        "store": False,
+        "prompt_cache_key": f"{PROMPT_CACHE_KEY_PREFIX}-{kind}",
+    }
+    line = {"custom_id": custom_id, "method": "POST", "url": "/v1/responses", "body": body}
+    return (json.dumps(line, ensure_ascii=False) + "\n").encode("utf-8")
+
+def _batch_output_text(body: dict) -> Optional[str]:
+    for item in body.get("output") or ():
+        if item.get("type") == "message":
+            for part in item.get("content") or ():
+                if part.get("type") == "output_text":
+                    return part.get("text")
+    return None
+
+@_retry_transient
+def _retrieve_batch(batch_id: str):
+    # a transient error while polling must not abandon a running batch
+    return client.batches.retrieve(batch_id)
+
+def _run_batch(kind: str, system: str, text_format, texts: List[str], model: str) -> list:
+    """
+    One batch job for the texts not already in the disk cache; blocks
+    (polling every BATCH_POLL_SECONDS) until it finishes. Returns one parsed
+    text_format per text, None where the request failed.
+    """
+    texts = [_canonicalize_safe_text(text) for text in texts]
+    results = [None] * len(texts)
+    pending = {}  # custom_id -> indices of the (identical) texts it answers
+    custom_ids = {}
+    for i, text in enumerate(texts):
+        results[i] = _cache_load(_cache_path(kind, model, text), text_format)
+        if results[i] is None:
+            cid = custom_ids.setdefault(text, f"{kind}-{len(custom_ids)}")
+            pending.setdefault(cid, []).append(i)
+    if not pending:
+        return results
+
+    jsonl = b"".join(
+        _batch_line(cid, system, texts[idx[0]], text_format, model, kind) for cid, idx in pending.items()
     )
-    return resp.output_parsed
+    batch_file = client.files.create(file=(f"{kind}_batch.jsonl", jsonl), purpose="batch")
+    batch = client.batches.create(
+        input_file_id=batch_file.id, endpoint="/v1/responses", completion_window="24h",
+    )
+    logger.info("%s batch %s submitted: %d requests", kind, batch.id, len(pending))
+    while batch.status not in BATCH_DONE:
+        time.sleep(BATCH_POLL_SECONDS)
+        batch = _retrieve_batch(batch.id)
+    if batch.status != "completed":
+        logger.warning("%s batch %s ended as %s", kind, batch.id, batch.status)
+
+    if batch.output_file_id:
+        for raw in client.files.content(batch.output_file_id).text.splitlines():
+            if not raw.strip():
+                continue
+            line = json.loads(raw)
+            idx = pending.get(line.get("custom_id"))
+            response = line.get("response") or {}
+            if idx is None or response.get("status_code") != 200:
+                continue
+            body = response.get("body") or {}
+            # e.g. "incomplete" (output cut off at the token limit): its
+            # text is not a complete object, treat it as failed
+            if body.get("status") != "completed":
+                logger.warning("%s batch %s: %s is %s", kind, batch.id, line["custom_id"], body.get("status"))
+                continue
+            output = _batch_output_text(body)
+            if output is None:
+                continue
+            usage = body.get("usage") or {}
+            logger.info("%s extraction [%s] (batch): %s input (%s cached) / %s output tokens",
+                        kind, model, usage.get("input_tokens"),
+                        (usage.get("input_tokens_details") or {}).get("cached_tokens") or 0,
+                        usage.get("output_tokens"))
+            try:
+                parsed = text_format.model_validate_json(output)
+            except ValidationError as e:
+                logger.warning("%s batch %s: %s output does not match %s: %s",
+                               kind, batch.id, line["custom_id"], text_format.__name__, e)
+                continue
+            for i in idx:
+                results[i] = parsed
+            _cache_store(_cache_path(kind, model, texts[idx[0]]), parsed)
+
+    failed = sum(results[idx[0]] is None for idx in pending.values())
+    if failed:
+        logger.warning("%s batch %s: %d of %d requests failed", kind, batch.id, failed, len(pending))
+    return results
+
+def ai_extract_invoice_batch(texts: List[str], model: str = "gpt-4o") -> List[Optional[InvoiceAI]]:
+    """ai_extract_invoice for many texts in one Batch API job (None where a request failed)."""
+    return _run_batch("invoice", SYSTEM, InvoiceAI, texts, model)
+
+def ai_extract_ead_batch(texts: List[str], model: str = "gpt-4o") -> List[Optional[EADAI]]:
+    """ai_extract_ead for many texts in one Batch API job (None where a request failed)."""
+    return _run_batch("ead", EAD_SYSTEM, EADAI, texts, model)
+
+def ai_extract_pair_batch(
+    invoice_texts: List[str], ead_texts: List[str], model: str = "gpt-4o"
+) -> Tuple[List[Optional[InvoiceAI]], List[Optional[EADAI]]]:
+    """
+    Batch counterpart of ai_extract_pair: the invoice and EAD batch jobs are
+    submitted and polled concurrently.
+    """
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        inv_future = ex.submit(ai_extract_invoice_batch, invoice_texts, model=model)
+        ead_future = ex.submit(ai_extract_ead_batch, ead_texts, model=model)
+        return inv_future.result(), ead_future.result()
@@ -9,22 +9,105 @@
 # 6) Match invoice lines -> EAD lines
 # 7) Validate shipment-level + line-level (customs-grade checks)
 # 8) Write packing_list.xlsx (fallback to CSV if openpyxl missing) + issues.json
+#
+# --batch JOBS_DIR runs the pipeline for every job directory under JOBS_DIR
+# (each holding the two stage1 text files), with step 3 going through the
+# OpenAI Batch API.
 
 from __future__ import annotations
 
+from functools import lru_cache
 from pathlib import Path
+from typing import TYPE_CHECKING
+import heapq
 import json
+import logging
+import mmap
+import os
 import re
-from collections import Counter
+import sys
 from rapidfuzz import fuzz 
-from openpyxl import load_workbook
 from io import BytesIO
 
-import pandas as pd
+# pandas, openpyxl and the OpenAI client (stage2b) take well over a second
+# to import together; they are imported where first needed, so matching /
+# validation callers and the CLI's text reading do not wait on them.
+if TYPE_CHECKING:
+    import pandas as pd
+
+try:
+    import orjson  # optional: C serializer for issues.json
+except ImportError:
+    orjson = None
 
-from stage2b_ai_extract_openai import ai_extract_invoice, ai_extract_ead
 from stage1b_redact_trim import redact, trim_invoice_text, trim_ead_text
 
+logger = logging.getLogger(__name__)
+
+# Compiled once at import; these run for every job / row
+# Invoice compliance + totals
+VAT_RE = re.compile(r"\bCod\.?Fisc\.?\s*e\s*P\.?Iva\s+([0-9]+)", re.IGNORECASE)
+CONSIGNEE_EORI_RE = re.compile(r"\bCodice\s+Eori\s+destinatario\s*=\s*([A-Z0-9]+)", re.IGNORECASE)
+INCOTERM_RE = re.compile(r"\bIncoterms?\s*=\s*([A-Z]{3})", re.IGNORECASE)
+REX_RE = re.compile(r"\bNumero\s+Rex\s+([A-Z0-9]+)", re.IGNORECASE)
+SUPPLIER_EORI_RE = re.compile(r"\bCodice\s+EORI\s+([A-Z0-9]+)", re.IGNORECASE)
+COMPLIANCE_COLLI_RE = re.compile(r"\bN\.?ro\s+Colli\b[\s\S]{0,80}?([0-9][0-9\.\,]*)", re.IGNORECASE)
+GROSS_KG_RE = re.compile(r"\bPeso\s+Lordo\s+Kg\b\.?\s*([0-9][0-9\.\,]*)", re.IGNORECASE | re.DOTALL)
+NET_KG_RE = re.compile(r"\bpeso\s+netto\s+Kg\b\.?\s*([0-9][0-9\.\,]*)", re.IGNORECASE | re.DOTALL)
+PALLET_RE = re.compile(r"\bposti\s+su\s+(\d+)\s+pallet", re.IGNORECASE)
+TOTAL_COLLI_RE = re.compile(r"\bN\.?ro\s+Colli\b\s*([0-9\.\,]+)", re.IGNORECASE)
+
+# EAD text
+SHIPPER_RE = re.compile(r"\(2\.b\)\s*Nome\s+dello\s+speditore\s*:", re.IGNORECASE)
+EAD_COLLI_RE = re.compile(r"\bNumero\s+di\s+colli\b:\s*([0-9\.\,]+)", re.IGNORECASE)
+
+# Every match of the invoice patterns and of EAD_COLLI_RE starts with one
+# of these keywords (case-insensitively). With IGNORECASE the re engine
+# cannot skip ahead to a literal prefix and tries the whole pattern at
+# every offset (~85 us per field on a 5 KB invoice); _keyed_search /
+# _keyed_finditer instead str.find() the keyword in a lowercased copy and
+# try the pattern only there.
+LEAD_KEYWORDS = {
+    VAT_RE: ("cod",),
+    CONSIGNEE_EORI_RE: ("codice",),
+    INCOTERM_RE: ("incoterm",),
+    REX_RE: ("numero",),
+    SUPPLIER_EORI_RE: ("codice",),
+    COMPLIANCE_COLLI_RE: ("nro", "n.ro"),
+    GROSS_KG_RE: ("peso",),
+    NET_KG_RE: ("peso",),
+    PALLET_RE: ("posti",),
+    TOTAL_COLLI_RE: ("nro", "n.ro"),
+    EAD_COLLI_RE: ("numero",),
+}
+
+# Row helpers
+# Bottles per case, e.g. "CRT DA 6 BTLS", "CASE OF 6 BOTTLES". (The former
+# second pattern, CASE\s+OF\s+(\d+)\s+BOTTLES?, only ever matched where
+# this one already did.) Possessive quantifiers: nothing after a whitespace
+# or digit run can use what it would give back, so a long whitespace run
+# after "CRT" fails in linear rather than quadratic time.
+BPC_RE = re.compile(
+    r"\b(?:CRT|CARTON|CARTONE|CASE)\s*+(?:DA|DI|OF)?\s*+(\d++)\s*+(?:BTLS|BOTTLES?|BOTTIGLIE|BOUTEILLES|BT)\b",
+    re.IGNORECASE,
+)
+WS_RE = re.compile(r"\s+")
+
+
+class _DigitsOnly(dict):
+    """
+    str.translate table that keeps decimal digits (str.isdecimal, the same
+    set a regex digit class matches) and drops everything else. Filled
+    lazily per code point, so it covers all of Unicode.
+    """
+    def __missing__(self, cp):
+        v = cp if chr(cp).isdecimal() else None
+        self[cp] = v
+        return v
+
+
+DIGITS_ONLY = _DigitsOnly()
+
 # Choose tolerances (weights are often rounded in docs)
     # absolute tolerance: 2 kg
     # relative tolerance: 1% of invoice value
@@ -37,8 +120,67 @@ def close_enough(a, b, abs_tol=0.0, rel_tol=0.01):
         return False
     return abs(a - b) <= max(abs_tol, rel_tol * max(abs(a), abs(b)))
 
+def _keyword_text(t: str) -> str | None:
+    """
+    Lowercased t for _keyed_search, or None when offsets in t.lower() would
+    not line up with t (a char lowering to several, e.g. "İ") or when t has
+    one of the non-ASCII letters IGNORECASE equates with i / s ("ı", "ſ").
+    """
+    tl = t.lower()
+    if len(tl) != len(t) or "ı" in t or "ſ" in t:
+        return None
+    return tl
+
+
+def _keyword_positions(tl: str, keyword: str):
+    q = tl.find(keyword)
+    while q != -1:
+        yield q
+        q = tl.find(keyword, q + 1)
+
+
+def _lead_positions(rx, tl: str):
+    keywords = LEAD_KEYWORDS[rx]
+    if len(keywords) == 1:
+        return _keyword_positions(tl, keywords[0])
+    return heapq.merge(*(_keyword_positions(tl, k) for k in keywords))
+
+
+def _keyed_search(rx, t: str, tl: str | None):
+    """
+    Same result as rx.search(t): tries rx.match at each occurrence of its
+    LEAD_KEYWORDS in order, since a match can only start at one of them.
+    """
+    if tl is None:
+        return rx.search(t)
+    for q in _lead_positions(rx, tl):
+        m = rx.match(t, q)
+        if m:
+            return m
+    return None
+
+
+def _keyed_finditer(rx, t: str, tl: str | None):
+    """
+    Same matches as rx.finditer(t): like _keyed_search, resuming after the
+    end of each match (the patterns never match empty).
+    """
+    if tl is None:
+        yield from rx.finditer(t)
+        return
+    end = 0
+    for q in _lead_positions(rx, tl):
+        if q < end:
+            continue
+        m = rx.match(t, q)
+        if m:
+            yield m
+            end = m.end()
+
+
 def extract_invoice_compliance(invoice_text: str) -> dict:
     t = invoice_text or ""
+    tl = _keyword_text(t)
 
     out = {
         "supplier_vat": None,           # P.IVA
@@ -54,101 +196,120 @@ def extract_invoice_compliance(invoice_text: str) -> dict:
     }
 
     # VAT / Cod.Fisc / P.IVA (simple heuristic)
-    m = re.search(r"\bCod\.?Fisc\.?\s*e\s*P\.?Iva\s+([0-9]+)", t, re.IGNORECASE)
+    m = _keyed_search(VAT_RE, t, tl)
     if m:
         out["supplier_vat"] = m.group(1).strip()
 
     # Consignee EORI (destinatario)
-    m = re.search(r"\bCodice\s+Eori\s+destinatario\s*=\s*([A-Z0-9]+)", t, re.IGNORECASE)
+    m = _keyed_search(CONSIGNEE_EORI_RE, t, tl)
     if m:
         out["consignee_eori"] = m.group(1).strip()
 
     # Incoterm
-    m = re.search(r"\bIncoterms?\s*=\s*([A-Z]{3})", t, re.IGNORECASE)
+    m = _keyed_search(INCOTERM_RE, t, tl)
     if m:
         out["incoterm"] = m.group(1).upper().strip()
 
     # Supplier REX + EORI (exporter)
-    m = re.search(r"\bNumero\s+Rex\s+([A-Z0-9]+)", t, re.IGNORECASE)
+    m = _keyed_search(REX_RE, t, tl)
     if m:
         out["supplier_rex"] = m.group(1).strip()
 
-    m = re.search(r"\bCodice\s+EORI\s+([A-Z0-9]+)", t, re.IGNORECASE)
+    m = _keyed_search(SUPPLIER_EORI_RE, t, tl)
     if m:
         out["supplier_eori"] = m.group(1).strip()
 
     # Colli / weights
-    m = re.search(r"\bN\.?ro\s+Colli\b[\s\S]{0,80}?([0-9][0-9\.\,]*)", t, re.IGNORECASE)
+    m = _keyed_search(COMPLIANCE_COLLI_RE, t, tl)
     if m:
         out["total_colli"] = parse_int_loose(m.group(1))
 
     # Peso lordo
-    m = re.search(
-    r"\bPeso\s+Lordo\s+Kg\b\.?\s*([0-9][0-9\.\,]*)",
-    t,
-    re.IGNORECASE | re.DOTALL
-    )
+    m = _keyed_search(GROSS_KG_RE, t, tl)
     if m:
         out["gross_kg"] = parse_float_locale(m.group(1))
 
     # Peso netto
-    m = re.search(
-    r"\bpeso\s+netto\s+Kg\b\.?\s*([0-9][0-9\.\,]*)",
-    t,
-    re.IGNORECASE | re.DOTALL
-    )
+    m = _keyed_search(NET_KG_RE, t, tl)
     if m:
         out["net_kg"] = parse_float_locale(m.group(1))
 
     # pallets (basic)
-    m = re.search(r"\bposti\s+su\s+(\d+)\s+pallet", t, re.IGNORECASE)
+    m = _keyed_search(PALLET_RE, t, tl)
     if m:
         out["pallet_count"] = int(m.group(1))
 
     return out
 
+# Checked in order; substring matches (no word boundaries), so e.g.
+# "RIOJA DOCA" still resolves to Italy through "DOC"
+COUNTRY_PATTERNS = [
+    (re.compile(r"DOC|DOCG|IGT|IGP|SICILIA|SICILIANE|ITALIA|NERO D'AVOLA|TERRE"), "Italy"),
+    (re.compile(r"AOC|AOP|BORDEAUX|BOURGOGNE|CHAMPAGNE"), "France"),
+    (re.compile(r"DOCA|DO|RIOJA|RIBERA"), "Spain"),
+]
+
+
 def country_from_denom(denom: str) -> str:
     if not isinstance(denom, str):
         denom = ""
     d = (denom or "").upper()
 
-    italy_tokens = ["DOC", "DOCG", "IGT", "IGP", "SICILIA", "SICILIANE", "ITALIA", "NERO D'AVOLA", "TERRE"]
-    if any(t in d for t in italy_tokens):
-        return "Italy"
-
-    if any(t in d for t in ["AOC", "AOP", "BORDEAUX", "BOURGOGNE", "CHAMPAGNE"]):
-        return "France"
-
-    if any(t in d for t in ["DOCA", "DOCa", "DO", "RIOJA", "RIBERA"]):
-        return "Spain"
+    for rx, country in COUNTRY_PATTERNS:
+        if rx.search(d):
+            return country
 
     return ""
 
 def shipper_name_from_ead_text(ead_text: str) -> str | None:
     t = ead_text or ""
-    # keep line structure
-    lines = [ln.strip() for ln in t.splitlines() if ln.strip()]
-
-    for i, ln in enumerate(lines):
-        if re.search(r"\(2\.b\)\s*Nome\s+dello\s+speditore\s*:", ln, re.IGNORECASE):
+    # keep line structure; walked lazily, since the shipper box (2.b) sits
+    # near the top and the rest of the document need not be stripped
+    prev = ""
+    for raw in t.splitlines():
+        ln = raw.strip()
+        if not ln:
+            continue
+        if SHIPPER_RE.search(ln):
             # what comes after colon (often just "AGRICOLA")
             parts = ln.split(":", 1)
             tail = parts[1].strip() if len(parts) > 1 else ""
 
             # previous line often contains the start of company name
-            prev = lines[i-1] if i > 0 else ""
 
             # Combine safely
             full = f"{prev} {tail}".strip()
-            full = re.sub(r"\s+", " ", full)
+            full = WS_RE.sub(" ", full)
 
             return full if full else None
+        prev = ln
 
     return None
 
 
-def build_customs_excel(matches, template_path: str, inv_ai, ead_text) -> bytes:
-    df = build_output_df(matches)
+# Output table columns read for each packing-list item row (B, C, D, E
+# from cases x bottles per case, F, G, H, I from the denomination)
+EXCEL_ITEM_COLUMNS = [
+    "DESCRIPTION",
+    "CUSTOMS COMMODITY CODE",
+    "% ALCOHOL",
+    "CASES / COLLI",
+    "BOTTLES PER CASE",
+    "GROSS WEIGHT (KG)",
+    "NET WEIGHT (KG)",
+    "INVOICE VALUE (EUR)",
+    "DENOMINAZIONE DI ORIGINE",
+]
+
+
+def build_customs_excel(matches, template_path: str, inv_ai, ead_text, df: pd.DataFrame | None = None) -> bytes:
+    import pandas as pd
+    from openpyxl import load_workbook
+
+    # Callers that already built the output table (app.run_one_job) pass it
+    # in, so the match rows are not converted to a DataFrame twice.
+    if df is None:
+        df = build_output_df(matches)
 
     wb = load_workbook(template_path)
     ws = wb.active
@@ -164,43 +325,52 @@ def build_customs_excel(matches, template_path: str, inv_ai, ead_text) -> bytes:
     start_row = 14  # where items start in template
 
     # --- Fill item rows ---
-    for idx, row in df.iterrows():
+    # ws.cell(row, column) skips the "A14"-style coordinate parsing, and
+    # plain tuples from itertuples skip building a Series per row.
+    # .value is assigned explicitly: ws.cell(..., value=None) would leave
+    # template content in place.
+    items = df.reindex(columns=EXCEL_ITEM_COLUMNS).itertuples(index=False, name=None)
+    # E/F/G/H column totals, summed as rows are written: what SUM() over the
+    # item range adds up (numbers only; blanks / NaN skipped)
+    totals = [0, 0, 0, 0]
+    # the same few denominations repeat across item rows
+    countries = {}
+    for idx, (desc, cn, abv, cases, bpc, gross, net, value, denom) in enumerate(items):
         r = start_row + idx
 
-        pieces = None
-        cases = row.get("CASES / COLLI")
-        bpc = row.get("BOTTLES PER CASE")
         if pd.notna(cases) and pd.notna(bpc):
             pieces = int(cases) * int(bpc)
         else:
             pieces = None
 
-        ws[f"A{r}"] = idx + 1
-        ws[f"B{r}"] = row["DESCRIPTION"]
-        ws[f"C{r}"] = row["CUSTOMS COMMODITY CODE"]
-        ws[f"D{r}"] = row["% ALCOHOL"]
-        ws[f"E{r}"] = pieces
-        ws[f"F{r}"] = row["GROSS WEIGHT (KG)"]
-        ws[f"G{r}"] = row["NET WEIGHT (KG)"]
-        ws[f"H{r}"] = row["INVOICE VALUE (EUR)"]
-        ws[f"I{r}"] = country_from_denom(row["DENOMINAZIONE DI ORIGINE"])
+        country = countries.get(denom)
+        if country is None:
+            country = countries[denom] = country_from_denom(denom)
+
+        row_values = (idx + 1, desc, cn, abv, pieces, gross, net, value, country)
+        for col, v in enumerate(row_values, start=1):
+            ws.cell(row=r, column=col).value = v
+
+        for k, v in enumerate((pieces, gross, net, value)):
+            if isinstance(v, (int, float)) and v == v:
+                totals[k] += v
 
     # --- Clear unused template rows ---
     last_filled_row = start_row + len(df) - 1
     max_template_rows = start_row + 20  # buffer
 
-    for r in range(last_filled_row + 1, max_template_rows):
-        for col in ["A","B","C","D","E","F","G","H","I"]:
-            ws[f"{col}{r}"] = None
+    for row in ws.iter_rows(min_row=last_filled_row + 1, max_row=max_template_rows - 1, min_col=1, max_col=9):
+        for cell in row:
+            cell.value = None
 
     # --- Dynamic TOTAL row ---
     total_row = start_row + len(df) + 1
 
+    # Literal values rather than =SUM() formulas: the totals are known here,
+    # so Excel has nothing to recalculate on open
     ws[f"C{total_row}"] = "TOTAL"
-    ws[f"E{total_row}"] = f"=SUM(E{start_row}:E{total_row-2})"
-    ws[f"F{total_row}"] = f"=SUM(F{start_row}:F{total_row-2})"
-    ws[f"G{total_row}"] = f"=SUM(G{start_row}:G{total_row-2})"
-    ws[f"H{total_row}"] = f"=SUM(H{start_row}:H{total_row-2})"
+    for col, total in zip("EFGH", totals):
+        ws[f"{col}{total_row}"] = total
 
     buf = BytesIO()
     wb.save(buf)
@@ -215,28 +385,44 @@ def token_set_ratio(a: str, b: str) -> float:
         b = (b or "").strip()
         if not a or not b:
             return 0.0
-        return float(fuzz.token_set_ratio(a, b))
+        return _token_set_ratio_cached(a, b)
+
+
+@lru_cache(maxsize=4096)
+def _token_set_ratio_cached(a: str, b: str) -> float:
+    # Keyed on the exact stripped strings: rapidfuzz's default_process
+    # (lowercase, drop punctuation) would change the scores
+    return float(fuzz.token_set_ratio(a, b))
 
 
 # -----------------------------
 # Helpers
 # -----------------------------
-def is_num(x):
-    return isinstance(x, (int, float)) and x is not None
-
-
 def safe_float(x):
+    # Missing fields are the common failure: answer None without paying
+    # for a raised and caught TypeError
+    if x is None:
+        return None
     try:
         return float(x)
     except Exception:
         return None
 
 
+def safe_int(x):
+    if x is None:
+        return None
+    try:
+        return int(x)
+    except Exception:
+        return None
+
+
 def parse_int_loose(x):
     if x is None:
         return None
     s = str(x).strip()
-    s = re.sub(r"[^\d]", "", s)
+    s = s.translate(DIGITS_ONLY)
     return int(s) if s else None
 
 
@@ -250,10 +436,11 @@ def parse_float_locale(x):
     if x is None:
         return None
     s = str(x).strip().replace(" ", "")
-    if "." in s and "," in s:
-        # thousand '.' and decimal ','
-        s = s.replace(".", "").replace(",", ".")
-    elif "," in s and "." not in s:
+    # No comma: already float() syntax, nothing to rewrite
+    if "," in s:
+        if "." in s:
+            # thousand '.' and decimal ','
+            s = s.replace(".", "")
         s = s.replace(",", ".")
     try:
         return float(s)
@@ -296,17 +483,12 @@ def bottles_per_case_from_desc(desc: str):
     if not desc:
         return None
 
-    patterns = [
-        r"\b(?:CRT|CARTON|CARTONE|CASE)\s*(?:DA|DI|OF)?\s*(\d+)\s*(?:BTLS|BOTTLES?|BOTTIGLIE|BOUTEILLES|BT)\b",
-        r"\bCASE\s+OF\s+(\d+)\s+BOTTLES?\b",
-    ]
-    for p in patterns:
-        m = re.search(p, desc, re.IGNORECASE)
-        if m:
-            try:
-                return int(m.group(1))
-            except Exception:
-                return None
+    m = BPC_RE.search(desc)
+    if m:
+        try:
+            return int(m.group(1))
+        except Exception:
+            return None
     return None
 
 
@@ -340,10 +522,25 @@ def liters_from_invoice(inv_line):
     return None
 
 
+def line_liters(line):
+    """
+    liters_from_invoice(line), taken from the "_liters_calc" value cached by
+    normalize_invoice_rows when the line has one.
+    """
+    if "_liters_calc" in line:
+        return line["_liters_calc"]
+    return liters_from_invoice(line)
+
+
 # ------------------------------------------------------------
 # Deterministic extraction from raw texts (for audits & origin)
 # ------------------------------------------------------------
-def extract_invoice_totals(invoice_text: str) -> dict:
+def extract_invoice_totals(invoice_text: str, compliance: dict | None = None) -> dict:
+    """
+    compliance: the extract_invoice_compliance() result for the same text.
+    Its gross_kg / net_kg come from the same regexes and parser, so they
+    are reused instead of scanning the text for them a second time.
+    """
     t = invoice_text or ""
     out = {
         "invoice_total_colli": None,
@@ -351,41 +548,35 @@ def extract_invoice_totals(invoice_text: str) -> dict:
         "invoice_net_kg": None,
     }
 
-    m = re.search(r"\bN\.?ro\s+Colli\b\s*([0-9\.\,]+)", t, re.IGNORECASE)
+    tl = _keyword_text(t)
+    m = _keyed_search(TOTAL_COLLI_RE, t, tl)
     if m:
         out["invoice_total_colli"] = parse_int_loose(m.group(1))
 
-    m = re.search(
-    r"\bPeso\s+Lordo\s+Kg\b\.?\s*([0-9][0-9\.\,]*)",
-    t,
-    re.IGNORECASE | re.DOTALL
-    )
-    print("DEBUG gross match:", m.group(1) if m else None)
+    if compliance is not None:
+        out["invoice_gross_kg"] = compliance.get("gross_kg")
+        out["invoice_net_kg"] = compliance.get("net_kg")
+        return out
+
+    m = _keyed_search(GROSS_KG_RE, t, tl)
     if m:
         out["invoice_gross_kg"] = parse_float_locale(m.group(1))
-    print("DEBUG parsed gross_kg:", out["invoice_gross_kg"], type(out["invoice_gross_kg"]))
-
 
-    m = re.search(
-    r"\bPeso\s+netto\s+Kg\b\.?\s*([0-9][0-9\.\,]*)",
-    t,
-    re.IGNORECASE | re.DOTALL
-    )
-    print("DEBUG gross match:", m.group(1) if m else None)
+    m = _keyed_search(NET_KG_RE, t, tl)
     if m:
         out["invoice_net_kg"] = parse_float_locale(m.group(1))
-    print("DEBUG parsed gross_kg:", out["invoice_net_kg"], type(out["invoice_net_kg"]))
 
     return out
 
 def extract_ead_packaging_colli_sum(ead_text: str) -> int | None:
     t = ead_text or ""
-    colli = re.findall(r"\bNumero\s+di\s+colli\b:\s*([0-9\.\,]+)", t, re.IGNORECASE)
-    if not colli:
-        return None
-    vals = [parse_int_loose(x) for x in colli]
-    vals = [v for v in vals if v is not None]
-    return sum(vals) if vals else None
+    # Parsed and summed as the matches are found; None if no value parses
+    total = None
+    for m in _keyed_finditer(EAD_COLLI_RE, t, _keyword_text(t)):
+        v = parse_int_loose(m.group(1))
+        if v is not None:
+            total = (total or 0) + v
+    return total
 
 # -----------------------------
 # Normalizers (AI -> dict lines)
@@ -398,7 +589,7 @@ def normalize_invoice_rows(ai_invoice) -> dict:
         if bpc is None:
             bpc = bottles_per_case_from_desc(desc)
 
-        lines.append({
+        line = {
             "description": desc,
             "cn_code": r.cn_code,
             "abv_percent": safe_float(r.abv_percent),
@@ -409,7 +600,12 @@ def normalize_invoice_rows(ai_invoice) -> dict:
             "bottles_per_case": bpc,
             "invoice_value_eur": safe_float(r.invoice_value_eur),
             "lot": r.lot,
-        })
+        }
+        # Derived once here; matching, both validators and the output table
+        # read them instead of recomputing per use (see line_liters)
+        line["_bottle_liters_norm"] = normalize_bottle_liters(line["bottle_liters"])
+        line["_liters_calc"] = liters_from_invoice(line)
+        lines.append(line)
 
     return {
         "invoice_number": getattr(ai_invoice, "invoice_number", None),
@@ -427,17 +623,18 @@ def normalize_ead_rows(ai_ead) -> dict:
         prog = r.progressivo if r.progressivo is not None else idx
         prog = int(prog)
 
-        desc = (getattr(r, "description", "") or "").strip()
+        # Each optional text field is read once
+        raw_desc = getattr(r, "description", None)
+        desc = (raw_desc or "").strip()
         extra = (getattr(r, "designazione_commerciale", "") or "").strip()
 
         if extra and extra.lower() not in desc.lower():
             designazione_commerciale = f"{desc} {extra}".strip()
         else:
-            designazione_commerciale = desc        
-        
-        designation = getattr(r, "designation", None) or getattr(r, "description", None) or ""
-        denominazione_origine = getattr(r, "denominazione_origine", None)
+            designazione_commerciale = desc
 
+        designation = getattr(r, "designation", None) or raw_desc or ""
+        denominazione_origine = getattr(r, "denominazione_origine", None)
 
         lines.append({
             "progressivo": prog,
@@ -446,9 +643,13 @@ def normalize_ead_rows(ai_ead) -> dict:
             "ead_liters": safe_float(r.ead_liters),
             "ead_gross_kg": safe_float(r.ead_gross_kg),
             "ead_net_kg": safe_float(r.ead_net_kg),
-            "designation": re.sub(r"\s+", " ", (designation or "")).strip(),
-            "denominazione_origine": re.sub(r"\s+", " ", denominazione_origine).strip() if denominazione_origine else None,
-            "designazione_commerciale": re.sub(r"\s+", " ", (designazione_commerciale or "")).strip() if designazione_commerciale else None,
+            # " ".join(s.split()): same as WS_RE.sub(" ", s).strip() (\s and
+            # str.split() share the Unicode whitespace set), without the regex
+            "designation": " ".join(designation.split()),
+            "denominazione_origine": " ".join(denominazione_origine.split()) if denominazione_origine else None,
+            "designazione_commerciale": (
+                " ".join(designazione_commerciale.split()) if designazione_commerciale else None
+            ),
             "cases": r.cases,  # often None per product line
         })
 
@@ -463,29 +664,87 @@ def normalize_ead_rows(ai_ead) -> dict:
 # -----------------------------
 # Matching
 # -----------------------------
-def match_invoice_to_ead(inv_lines, ead_lines):
-    used = set()
+def _cn_key(cn):
+    # Same normalization as the CN hard filter: str().strip() of a truthy code
+    return str(cn).strip() if cn else None
+
+
+# MATCH_OPTIMAL=1 pairs lines by a global optimal assignment instead of
+# greedily in invoice order. It needs scipy (optional, not in requirements.txt);
+# without it a warning is logged and the greedy matcher runs.
+MATCH_OPTIMAL = os.getenv("MATCH_OPTIMAL", "0") == "1"
+
+
+def match_invoice_to_ead(inv_lines, ead_lines, *, optimal: bool | None = None):
+    if optimal is None:
+        optimal = MATCH_OPTIMAL
+    if optimal:
+        try:
+            return match_invoice_to_ead_optimal(inv_lines, ead_lines)
+        except ImportError as e:
+            logger.warning("optimal matching needs scipy (%s); using the greedy matcher", e)
+
     matches = []
 
+    # Bucket EAD line indices by CN code once. An invoice line with a CN can
+    # only match EAD lines with the same CN or with none, so it scans just
+    # those two buckets (merged back into document order, which keeps the
+    # first-best tie-break) instead of every EAD line.
+    ead_by_cn = {}
+    ead_no_cn = []
+    for j, ead in enumerate(ead_lines):
+        key = _cn_key(ead.get("cn_code"))
+        if key is None:
+            ead_no_cn.append(j)
+        else:
+            ead_by_cn.setdefault(key, []).append(j)
+    all_eads = range(len(ead_lines))
+
+    # EAD fields read for every candidate pair, pulled out of the line dicts
+    # once into parallel lists indexed like ead_lines. Names are pre-stripped;
+    # cases / ABV are converted up front, None where int() / float() fails
+    # (such a pair gets no cases / ABV score, as before).
+    ead_liters = [ead.get("ead_liters") for ead in ead_lines]
+    ead_cases = [safe_int(ead.get("cases")) for ead in ead_lines]
+    ead_abvs = [safe_float(ead.get("abv_percent")) for ead in ead_lines]
+    ead_names = [(ead.get("designation") or "").strip() for ead in ead_lines]
+
+    # Each distinct progressivo gets a dense slot in a bytearray of "used"
+    # flags, so the inner loop indexes instead of hashing into a set
+    # (lines sharing a progressivo share its slot).
+    slots = {}
+    ead_slots = [slots.setdefault(ead["progressivo"], len(slots)) for ead in ead_lines]
+    used = bytearray(len(slots))
+
     for inv in inv_lines:
         best = None
         best_score = -1
+        best_j = -1
 
-        for ead in ead_lines:
-            if ead["progressivo"] in used:
-                continue
+        inv_cn = _cn_key(inv.get("cn_code"))
+        if inv_cn is None:
+            candidates = all_eads
+        else:
+            candidates = heapq.merge(ead_by_cn.get(inv_cn, ()), ead_no_cn)
 
-            # Hard filter: CN code if present on both
-            if inv.get("cn_code") and ead.get("cn_code"):
-                if str(inv["cn_code"]).strip() != str(ead["cn_code"]).strip():
-                    continue
+        # Per-invoice values, computed once rather than per candidate
+        inv_liters = line_liters(inv)
+        inv_cases = safe_int(inv.get("cases"))
+        inv_abv = safe_float(inv.get("abv_percent"))
+        inv_name = (inv.get("description") or "").strip()
+
+        # 1) Numeric score of every free candidate, grouped by score value
+        # (only a few dozen distinct sums exist), in document order
+        by_score = {}
+        for j in candidates:
+            if used[ead_slots[j]]:
+                continue
 
             score = 0
 
             # Liters strongest
-            inv_liters = liters_from_invoice(inv)
-            if inv_liters is not None and ead.get("ead_liters") is not None:
-                diff = abs(inv_liters - ead["ead_liters"])
+            if inv_liters is not None and ead_liters[j] is not None:
+                diff = abs(inv_liters - ead_liters[j])
                 if diff <= 0.5:
                     score += 80
                 elif diff <= 2.0:
@@ -494,45 +753,165 @@ def match_invoice_to_ead(inv_lines, ead_lines):
                     score -= 50
 
             # Cases (if EAD provides per-line cases)
-            if inv.get("cases") is not None and ead.get("cases") is not None:
-                try:
-                    score += 40 if int(inv["cases"]) == int(ead["cases"]) else -30
-                except Exception:
-                    pass
+            if inv_cases is not None and ead_cases[j] is not None:
+                score += 40 if inv_cases == ead_cases[j] else -30
 
             # ABV soft
-            if inv.get("abv_percent") is not None and ead.get("abv_percent") is not None:
-                try:
-                    diff_abv = abs(float(inv["abv_percent"]) - float(ead["abv_percent"]))
-                    if diff_abv <= 0.3:
-                        score += 25
-                    elif diff_abv <= 0.7:
-                        score += 10
-                    else:
-                        score -= 25
-                except Exception:
-                    pass
-
-            # Description tie-breaker
-            inv_name = (inv.get("description") or "").strip()
-            ead_name = (ead.get("designation") or "").strip()
-            if inv_name and ead_name:
-                score += token_set_ratio(inv_name, ead_name) / 2.0
-
-            if score > best_score:
-                best_score = score
-                best = ead
+            if inv_abv is not None and ead_abvs[j] is not None:
+                diff_abv = abs(inv_abv - ead_abvs[j])
+                if diff_abv <= 0.3:
+                    score += 25
+                elif diff_abv <= 0.7:
+                    score += 10
+                else:
+                    score -= 25
+
+            # The name adds at most 50: below -50 the total cannot beat the
+            # initial best_score of -1
+            if score > -51:
+                by_score.setdefault(score, []).append(j)
+
+        # 2) Description tie-breaker, best numeric scores first. The result is
+        # the same as scanning in document order and keeping the first strict
+        # best: the highest total wins, the lowest j among equal totals. Once
+        # even a perfect name (+50) cannot reach best_score, stop.
+        for num in sorted(by_score, reverse=True):
+            if num + 50 < best_score:
+                break
+            for j in by_score[num]:
+                if num + 50 == best_score and j > best_j:
+                    break  # could only tie with an earlier line
+
+                # Names are pre-stripped and non-empty, so call rapidfuzz
+                # directly rather than the token_set_ratio wrapper. Below
+                # score_cutoff rapidfuzz may bail out early and return 0;
+                # such a name could not lift this candidate to best_score.
+                score = num
+                ead_name = ead_names[j]
+                if inv_name and ead_name:
+                    cutoff = max(0.0, 2.0 * (best_score - num) - 1e-6)
+                    score += fuzz.token_set_ratio(inv_name, ead_name, score_cutoff=cutoff) / 2.0
+
+                if score > best_score or (score == best_score and j < best_j):
+                    best_score = score
+                    best_j = j
+
+        if best_j >= 0:
+            best = ead_lines[best_j]
+            best_slot = ead_slots[best_j]
 
         if best:
-            used.add(best["progressivo"])
+            used[best_slot] = 1
         matches.append((inv, best, best_score))
 
     return matches
 
 
+def _band(diff, bands, miss):
+    """Vectorized score of |a - b| against (limit, score) bands; 0 where NaN."""
+    import numpy as np
+
+    out = np.where(np.isnan(diff), 0, miss)
+    for limit, score in reversed(bands):
+        out = np.where(diff <= limit, score, out)
+    return out
+
+
+def match_invoice_to_ead_optimal(inv_lines, ead_lines):
+    """
+    Same pair score as match_invoice_to_ead (CN hard filter, liters, cases,
+    ABV, name tie-breaker), but computed for all pairs at once as a NumPy
+    matrix (names via rapidfuzz's cdist) and paired by
+    scipy.optimize.linear_sum_assignment, maximizing the total score over
+    the shipment. The greedy matcher takes the best EAD line for each invoice
+    line in turn, so an early line can take the EAD line a later one needed;
+    this pairing cannot. Pairs scoring -1 or less stay unmatched, as in
+    match_invoice_to_ead, and EAD lines sharing a progressivo are used at
+    most once. Same result shape as match_invoice_to_ead.
+
+    Raises ImportError when scipy is not installed.
+    """
+    from scipy.optimize import linear_sum_assignment
+    from rapidfuzz.process import cdist
+    import numpy as np
+
+    if not inv_lines or not ead_lines:
+        return [(inv, None, -1) for inv in inv_lines]
+
+    def column(values):
+        return np.array([np.nan if v is None else float(v) for v in values], dtype=np.float64)
+
+    inv_liters = column(line_liters(inv) for inv in inv_lines)
+    inv_cases = column(safe_int(inv.get("cases")) for inv in inv_lines)
+    inv_abvs = column(safe_float(inv.get("abv_percent")) for inv in inv_lines)
+    inv_names = [(inv.get("description") or "").strip() for inv in inv_lines]
+    ead_liters = column(ead.get("ead_liters") for ead in ead_lines)
+    ead_cases = column(safe_int(ead.get("cases")) for ead in ead_lines)
+    ead_abvs = column(safe_float(ead.get("abv_percent")) for ead in ead_lines)
+    ead_names = [(ead.get("designation") or "").strip() for ead in ead_lines]
+
+    num = _band(np.abs(inv_liters[:, None] - ead_liters[None, :]), ((0.5, 80), (2.0, 50)), -50)
+    cases_eq = inv_cases[:, None] == ead_cases[None, :]
+    cases_known = ~(np.isnan(inv_cases)[:, None] | np.isnan(ead_cases)[None, :])
+    num = num + np.where(cases_known, np.where(cases_eq, 40, -30), 0)
+    num = num + _band(np.abs(inv_abvs[:, None] - ead_abvs[None, :]), ((0.3, 25), (0.7, 10)), -25)
+
+    # Empty names score 0 in token_set_ratio, i.e. add nothing, as in the
+    # greedy matcher
+    name = cdist(inv_names, ead_names, scorer=fuzz.token_set_ratio, dtype=np.float64) / 2.0
+    score = num + name
+
+    inv_cns = [_cn_key(inv.get("cn_code")) for inv in inv_lines]
+    ead_cns = [_cn_key(ead.get("cn_code")) for ead in ead_lines]
+    allowed = np.array([
+        [ic is None or ec is None or ic == ec for ec in ead_cns] for ic in inv_cns
+    ], dtype=bool)
+
+    # One column per progressivo, holding its best line (lowest index on ties)
+    slots = {}
+    for j, ead in enumerate(ead_lines):
+        slots.setdefault(ead["progressivo"], []).append(j)
+    slot_lines = list(slots.values())
+    weight = np.where(allowed, score + 1.0, 0.0)  # unmatched is worth -1
+    best_j = np.empty((len(inv_lines), len(slot_lines)), dtype=np.intp)
+    slot_weight = np.empty(best_j.shape, dtype=np.float64)
+    for s, js in enumerate(slot_lines):
+        pick = np.asarray(js)[np.argmax(weight[:, js], axis=1)]
+        best_j[:, s] = pick
+        slot_weight[:, s] = weight[np.arange(len(inv_lines)), pick]
+
+    rows, cols = linear_sum_assignment(np.maximum(slot_weight, 0.0), maximize=True)
+    paired = {}
+    for i, s in zip(rows, cols):
+        if slot_weight[i, s] > 0:
+            j = int(best_j[i, s])
+            n = int(num[i, j])
+            paired[i] = (ead_lines[j], n + float(name[i, j]) if inv_names[i] and ead_names[j] else n)
+
+    matches = []
+    for i, inv in enumerate(inv_lines):
+        ead, sc = paired.get(i, (None, -1))
+        matches.append((inv, ead, sc))
+    return matches
+
+
 # -----------------------------
 # Validation (Line-level + Shipment-level)
 # -----------------------------
+# Severity order for reporting (higher = more severe)
+SEVERITY_RANK = {"WARN": 1, "FAIL": 2}
+
+# Invoice fields every matched line must carry, with the severity when missing
+REQUIRED_INVOICE_FIELDS = (
+    ("description", "WARN"),
+    ("cn_code", "FAIL"),
+    ("abv_percent", "WARN"),
+    ("cases", "FAIL"),
+    ("bottles_per_case", "FAIL"),
+    ("bottle_liters", "FAIL"),
+)
+
+
 def validate_lines(matches, *, liters_tol=0, abv_tol_warn=0, abv_tol_fail=0, name_warn_threshold=100.0):
     """
     Classes:
@@ -542,60 +921,78 @@ def validate_lines(matches, *, liters_tol=0, abv_tol_warn=0, abv_tol_fail=0, nam
     """
     issues = []
 
-    def add(check_class, issue_type, severity, **kwargs):
-        issues.append({"check_class": check_class, "type": issue_type, "severity": severity, **kwargs})
-
     for inv, ead, score in matches:
         inv_desc = (inv.get("description") or "").strip()
 
         # Must have match
         if ead is None:
-            add("PRODUCT_IDENTITY_CHECK", "NO_MATCH", "FAIL", invoice_desc=inv_desc, match_score=score)
+            issues.append({
+                "check_class": "PRODUCT_IDENTITY_CHECK", "type": "NO_MATCH", "severity": "FAIL",
+                "invoice_desc": inv_desc, "match_score": score,
+            })
             continue
 
         # Completeness: invoice per-row mandatory
-        required_inv = ["description", "cn_code", "abv_percent", "cases", "bottles_per_case", "bottle_liters"]
-        for f in required_inv:
+        for f, sev in REQUIRED_INVOICE_FIELDS:
             v = inv.get(f)
             if v is None or (isinstance(v, str) and not v.strip()):
-                sev = "FAIL" if f in ("cases", "bottles_per_case", "bottle_liters", "cn_code") else "WARN"
-                add("COMPLETENESS_CHECK", "MISSING_INVOICE_FIELD", sev, invoice_desc=inv_desc, missing_field=f)
+                issues.append({
+                    "check_class": "COMPLETENESS_CHECK", "type": "MISSING_INVOICE_FIELD", "severity": sev,
+                    "invoice_desc": inv_desc, "missing_field": f,
+                })
 
         # Completeness: EAD liters
-        if ead.get("ead_liters") is None:
-            add("COMPLETENESS_CHECK", "MISSING_EAD_LITERS", "FAIL", invoice_desc=inv_desc, ead_progressivo=ead.get("progressivo"))
+        ead_liters = ead.get("ead_liters")
+        if ead_liters is None:
+            issues.append({
+                "check_class": "COMPLETENESS_CHECK", "type": "MISSING_EAD_LITERS", "severity": "FAIL",
+                "invoice_desc": inv_desc, "ead_progressivo": ead.get("progressivo"),
+            })
 
         # CN mismatch
         inv_cn = inv.get("cn_code")
         ead_cn = ead.get("cn_code")
         if inv_cn and ead_cn and str(inv_cn).strip() != str(ead_cn).strip():
-            add("PRODUCT_IDENTITY_CHECK", "CN_CODE_MISMATCH", "FAIL",
-                invoice_desc=inv_desc, invoice_cn_code=inv_cn, ead_cn_code=ead_cn)
+            issues.append({
+                "check_class": "PRODUCT_IDENTITY_CHECK", "type": "CN_CODE_MISMATCH", "severity": "FAIL",
+                "invoice_desc": inv_desc, "invoice_cn_code": inv_cn, "ead_cn_code": ead_cn,
+            })
 
         # ABV mismatch
         inv_abv = safe_float(inv.get("abv_percent"))
         ead_abv = safe_float(ead.get("abv_percent"))
-        if is_num(inv_abv) and is_num(ead_abv):
+        if inv_abv is not None and ead_abv is not None:
             diff_abv = abs(inv_abv - ead_abv)
             if diff_abv > abv_tol_fail:
-                add("PRODUCT_IDENTITY_CHECK", "ABV_MISMATCH", "FAIL",
-                    invoice_desc=inv_desc, invoice_abv=inv_abv, ead_abv=ead_abv, diff=diff_abv)
+                issues.append({
+                    "check_class": "PRODUCT_IDENTITY_CHECK", "type": "ABV_MISMATCH", "severity": "FAIL",
+                    "invoice_desc": inv_desc, "invoice_abv": inv_abv, "ead_abv": ead_abv, "diff": diff_abv,
+                })
             elif diff_abv > abv_tol_warn:
-                add("PRODUCT_IDENTITY_CHECK", "ABV_MISMATCH", "WARN",
-                    invoice_desc=inv_desc, invoice_abv=inv_abv, ead_abv=ead_abv, diff=diff_abv)
+                issues.append({
+                    "check_class": "PRODUCT_IDENTITY_CHECK", "type": "ABV_MISMATCH", "severity": "WARN",
+                    "invoice_desc": inv_desc, "invoice_abv": inv_abv, "ead_abv": ead_abv, "diff": diff_abv,
+                })
 
         # Bottle size sanity
         bl = safe_float(inv.get("bottle_liters"))
         if bl is not None and (bl < 0.05 or bl > 5.0):
-            add("PRODUCT_IDENTITY_CHECK", "BOTTLE_SIZE_SUSPICIOUS", "WARN", invoice_desc=inv_desc, bottle_liters=bl)
+            issues.append({
+                "check_class": "PRODUCT_IDENTITY_CHECK", "type": "BOTTLE_SIZE_SUSPICIOUS", "severity": "WARN",
+                "invoice_desc": inv_desc, "bottle_liters": bl,
+            })
 
         # Liters invariant
-        inv_liters = liters_from_invoice(inv)
-        ead_liters = ead.get("ead_liters")
-        if is_num(inv_liters) and is_num(ead_liters):
+        # safe_float / line_liters give a float or None; ead_liters is the raw
+        # field, so it still needs the type check (a str is skipped, not compared)
+        inv_liters = line_liters(inv)
+        ead_liters_num = isinstance(ead_liters, (int, float))
+        if inv_liters is not None and ead_liters_num:
             if abs(inv_liters - ead_liters) > liters_tol:
-                add("QUANTITY_INTEGRITY_CHECK", "LITERS_MISMATCH", "FAIL",
-                    invoice_desc=inv_desc, invoice_calc_liters=inv_liters, ead_liters=ead_liters)
+                issues.append({
+                    "check_class": "QUANTITY_INTEGRITY_CHECK", "type": "LITERS_MISMATCH", "severity": "FAIL",
+                    "invoice_desc": inv_desc, "invoice_calc_liters": inv_liters, "ead_liters": ead_liters,
+                })
 
         # Cases mismatch (only if EAD has per-line cases)
         inv_cases = inv.get("cases")
@@ -603,41 +1000,55 @@ def validate_lines(matches, *, liters_tol=0, abv_tol_warn=0, abv_tol_fail=0, nam
         if inv_cases is not None and ead_cases is not None:
             try:
                 if int(inv_cases) != int(ead_cases):
-                    add("QUANTITY_INTEGRITY_CHECK", "CASES_MISMATCH", "FAIL",
-                        invoice_desc=inv_desc, invoice_cases=inv_cases, ead_cases=ead_cases)
+                    issues.append({
+                        "check_class": "QUANTITY_INTEGRITY_CHECK", "type": "CASES_MISMATCH", "severity": "FAIL",
+                        "invoice_desc": inv_desc, "invoice_cases": inv_cases, "ead_cases": ead_cases,
+                    })
             except Exception:
-                add("QUANTITY_INTEGRITY_CHECK", "CASES_PARSE_ERROR", "WARN",
-                    invoice_desc=inv_desc, invoice_cases=inv_cases, ead_cases=ead_cases)
+                issues.append({
+                    "check_class": "QUANTITY_INTEGRITY_CHECK", "type": "CASES_PARSE_ERROR", "severity": "WARN",
+                    "invoice_desc": inv_desc, "invoice_cases": inv_cases, "ead_cases": ead_cases,
+                })
 
         # Weight sanity
         gross = safe_float(ead.get("ead_gross_kg"))
         net = safe_float(ead.get("ead_net_kg"))
-        if is_num(gross) and is_num(net) and gross <= net:
-            add("QUANTITY_INTEGRITY_CHECK", "WEIGHT_GROSS_LE_NET", "WARN",
-                invoice_desc=inv_desc, ead_gross_kg=gross, ead_net_kg=net)
+        if gross is not None and net is not None and gross <= net:
+            issues.append({
+                "check_class": "QUANTITY_INTEGRITY_CHECK", "type": "WEIGHT_GROSS_LE_NET", "severity": "WARN",
+                "invoice_desc": inv_desc, "ead_gross_kg": gross, "ead_net_kg": net,
+            })
 
-        if is_num(net) and is_num(ead_liters):
+        if net is not None and ead_liters_num:
             if abs(net - ead_liters) > max(2.0, 0.02 * ead_liters):
-                add("QUANTITY_INTEGRITY_CHECK", "NETKG_LITERS_SUSPICIOUS", "WARN",
-                    invoice_desc=inv_desc, ead_net_kg=net, ead_liters=ead_liters)
+                issues.append({
+                    "check_class": "QUANTITY_INTEGRITY_CHECK", "type": "NETKG_LITERS_SUSPICIOUS", "severity": "WARN",
+                    "invoice_desc": inv_desc, "ead_net_kg": net, "ead_liters": ead_liters,
+                })
 
         # Name similarity (warn only)
-        inv_name = (inv.get("description") or "").strip()
         ead_name = (ead.get("description") or "").strip()
-        if inv_name and ead_name:
-            sim = token_set_ratio(inv_name, ead_name)
+        if inv_desc and ead_name:
+            sim = token_set_ratio(inv_desc, ead_name)
             if sim < name_warn_threshold:
-                add("PRODUCT_IDENTITY_CHECK", "LOW_NAME_SIMILARITY", "WARN",
-                    invoice_desc=inv_desc, similarity=sim, invoice_name=inv_name, ead_name=ead_name)
+                issues.append({
+                    "check_class": "PRODUCT_IDENTITY_CHECK", "type": "LOW_NAME_SIMILARITY", "severity": "WARN",
+                    "invoice_desc": inv_desc, "similarity": sim, "invoice_name": inv_desc, "ead_name": ead_name,
+                })
 
         # Lot presence (warn only)
         if inv.get("lot") is None:
-            add("PRODUCT_IDENTITY_CHECK", "MISSING_LOT", "WARN", invoice_desc=inv_desc)
+            issues.append({
+                "check_class": "PRODUCT_IDENTITY_CHECK", "type": "MISSING_LOT", "severity": "WARN",
+                "invoice_desc": inv_desc,
+            })
 
         # Denominazione di origine (you explicitly want it)
         if ead.get("denominazione_origine") is None:
-            add("COMPLETENESS_CHECK", "MISSING_DENOMINAZIONE_ORIGINE", "WARN",
-                invoice_desc=inv_desc, ead_progressivo=ead.get("progressivo"))
+            issues.append({
+                "check_class": "COMPLETENESS_CHECK", "type": "MISSING_DENOMINAZIONE_ORIGINE", "severity": "WARN",
+                "invoice_desc": inv_desc, "ead_progressivo": ead.get("progressivo"),
+            })
 
     return issues
 
@@ -651,24 +1062,27 @@ def validate_shipment(inv_ai, ead_ai, inv_lines, ead_lines, *, invoice_text: str
       - Packaging sanity: total bottles / total colli approx bottles_per_case mode
     """
     issues = []
-
-    def add(check_class, issue_type, severity, **kwargs):
-        issues.append({"check_class": check_class, "type": issue_type, "severity": severity, **kwargs})
     
     inv_comp = extract_invoice_compliance(invoice_text)
     # ------------------------------------------------------------
     # invoice weight presence check
     # ------------------------------------------------------------
-    inv_meta = extract_invoice_totals(invoice_text)
+    inv_meta = extract_invoice_totals(invoice_text, compliance=inv_comp)
 
     inv_gross_kg = inv_meta.get("invoice_gross_kg")
     inv_net_kg = inv_meta.get("invoice_net_kg")
 
     if inv_gross_kg is None:
-        add("COMPLETENESS_CHECK", "MISSING_INVOICE_GROSS_KG", "WARN",inv_gross_kg = inv_gross_kg)
+        issues.append({
+            "check_class": "COMPLETENESS_CHECK", "type": "MISSING_INVOICE_GROSS_KG", "severity": "WARN",
+            "inv_gross_kg": inv_gross_kg,
+        })
 
     if inv_net_kg is None:
-        add("COMPLETENESS_CHECK", "MISSING_INVOICE_NET_KG", "WARN",inv_net_kg = inv_net_kg)
+        issues.append({
+            "check_class": "COMPLETENESS_CHECK", "type": "MISSING_INVOICE_NET_KG", "severity": "WARN",
+            "inv_net_kg": inv_net_kg,
+        })
     # ---- Compliance completeness checks (Invoice) ----
     mandatory_invoice = [
         ("supplier_vat", "MISSING_SUPPLIER_VAT"),
@@ -683,11 +1097,17 @@ def validate_shipment(inv_ai, ead_ai, inv_lines, ead_lines, *, invoice_text: str
 
     for key, issue_type in mandatory_invoice:
         if not inv_comp.get(key):
-            add("COMPLETENESS_CHECK", issue_type, "FAIL",field = inv_comp.get(key))
+            issues.append({
+                "check_class": "COMPLETENESS_CHECK", "type": issue_type, "severity": "FAIL",
+                "field": inv_comp.get(key),
+            })
 
     # Pallets: often required but sometimes absent -> warn (your choice)
     if not inv_comp.get("pallet_count"):
-        add("COMPLETENESS_CHECK", "MISSING_PALLET_COUNT", "WARN",field = "pallet_count")
+        issues.append({
+            "check_class": "COMPLETENESS_CHECK", "type": "MISSING_PALLET_COUNT", "severity": "WARN",
+            "field": "pallet_count",
+        })
         
     inv_no = getattr(inv_ai, "invoice_number", None)
     ead_no = getattr(ead_ai, "invoice_number", None)
@@ -698,61 +1118,109 @@ def validate_shipment(inv_ai, ead_ai, inv_lines, ead_lines, *, invoice_text: str
 
     # Completeness (headers)
     if not inv_no:
-        add("COMPLETENESS_CHECK", "MISSING_INVOICE_NUMBER", "FAIL", field = "inv_no")
+        issues.append({
+            "check_class": "COMPLETENESS_CHECK", "type": "MISSING_INVOICE_NUMBER", "severity": "FAIL",
+            "field": "inv_no",
+        })
     if not ead_no:
-        add("COMPLETENESS_CHECK", "MISSING_EAD_INVOICE_NUMBER", "FAIL", field = "ead_no")
+        issues.append({
+            "check_class": "COMPLETENESS_CHECK", "type": "MISSING_EAD_INVOICE_NUMBER", "severity": "FAIL",
+            "field": "ead_no",
+        })
     if not inv_arc:
-        add("COMPLETENESS_CHECK", "MISSING_ARC_IN_INVOICE", "FAIL", field = "inv_arc")
+        issues.append({
+            "check_class": "COMPLETENESS_CHECK", "type": "MISSING_ARC_IN_INVOICE", "severity": "FAIL",
+            "field": "inv_arc",
+        })
     if not ead_arc:
-        add("COMPLETENESS_CHECK", "MISSING_ARC_IN_EAD", "FAIL", field = "ead_arc")
+        issues.append({
+            "check_class": "COMPLETENESS_CHECK", "type": "MISSING_ARC_IN_EAD", "severity": "FAIL",
+            "field": "ead_arc",
+        })
 
     # Document consistency
     if inv_arc and ead_arc and str(inv_arc).strip() != str(ead_arc).strip():
-        add("DOCUMENT_CONSISTENCY_CHECK", "ARC_MISMATCH", "FAIL", invoice_arc=inv_arc, ead_arc=ead_arc)
+        issues.append({
+            "check_class": "DOCUMENT_CONSISTENCY_CHECK", "type": "ARC_MISMATCH", "severity": "FAIL",
+            "invoice_arc": inv_arc, "ead_arc": ead_arc,
+        })
 
     if inv_no and ead_no and str(inv_no).strip() != str(ead_no).strip():
-        add("DOCUMENT_CONSISTENCY_CHECK", "INVOICE_NUMBER_MISMATCH", "FAIL", invoice_number=inv_no, ead_invoice_number=ead_no)
+        issues.append({
+            "check_class": "DOCUMENT_CONSISTENCY_CHECK", "type": "INVOICE_NUMBER_MISMATCH", "severity": "FAIL",
+            "invoice_number": inv_no, "ead_invoice_number": ead_no,
+        })
 
     if inv_date and ead_date and str(inv_date).strip() != str(ead_date).strip():
-        add("DOCUMENT_CONSISTENCY_CHECK", "INVOICE_DATE_MISMATCH", "WARN", invoice_date=str(inv_date), ead_invoice_date=str(ead_date))
+        issues.append({
+            "check_class": "DOCUMENT_CONSISTENCY_CHECK", "type": "INVOICE_DATE_MISMATCH", "severity": "WARN",
+            "invoice_date": str(inv_date), "ead_invoice_date": str(ead_date),
+        })
 
-    # Totals: liters
-    inv_liters_vals = []
+    # Invoice totals (liters, cases, bottles, bottles-per-case counts) and
+    # EAD totals (liters, cases, gross / net kg), one pass over each list.
+    # Float totals add up in line order from 0: None while no line has the
+    # value.
+    inv_liters_sum = None
+    inv_cases_sum = 0
+    total_bottles = 0
+    bpc_counts = {}  # insertion-ordered: ties go to the first value seen
     for l in inv_lines:
-        lit = liters_from_invoice(l)
-        if lit is not None:
-            inv_liters_vals.append(float(lit))
-    inv_liters_sum = sum(inv_liters_vals) if inv_liters_vals else None
+        v = line_liters(l)
+        if v is not None:
+            inv_liters_sum = (inv_liters_sum or 0) + float(v)
+        c = l.get("cases")
+        inv_cases_sum += int(c or 0)
+        bpc = l.get("bottles_per_case")
+        if bpc is not None:
+            try:
+                k = int(bpc)
+                bpc_counts[k] = bpc_counts.get(k, 0) + 1
+            except Exception:
+                pass
+            if c is not None:
+                try:
+                    total_bottles += int(c) * int(bpc)
+                except Exception:
+                    pass
 
-    ead_liters_vals = []
-    
+    ead_liters_sum = ead_gross_sum = ead_net_sum = None
+    ead_cases_sum = 0
     for l in ead_lines:
-        lit = liters_from_invoice(l)
-        if lit is not None:
-            ead_liters_vals.append(float(lit))
-    ead_liters_sum = sum(ead_liters_vals) if ead_liters_vals else None
+        v = line_liters(l)
+        if v is not None:
+            ead_liters_sum = (ead_liters_sum or 0) + float(v)
+        ead_cases_sum += int(l.get("cases") or 0)
+        v = l.get("ead_gross_kg")
+        if v is not None:
+            ead_gross_sum = (ead_gross_sum or 0) + float(v)
+        v = l.get("ead_net_kg")
+        if v is not None:
+            ead_net_sum = (ead_net_sum or 0) + float(v)
+
+    # Totals: liters
 
     if inv_liters_sum is not None and ead_liters_sum is not None:
         if abs(inv_liters_sum - ead_liters_sum) > max(1.0, 0.005 * ead_liters_sum):
-            add("QUANTITY_INTEGRITY_CHECK", "TOTAL_LITERS_MISMATCH", "FAIL",
-                invoice_calc_liters_total=inv_liters_sum, ead_liters_total=ead_liters_sum)
+            issues.append({
+                "check_class": "QUANTITY_INTEGRITY_CHECK", "type": "TOTAL_LITERS_MISMATCH", "severity": "FAIL",
+                "invoice_calc_liters_total": inv_liters_sum, "ead_liters_total": ead_liters_sum,
+            })
 
     # Totals: cases (only if EAD has per-line cases)
-    inv_cases_sum = sum(int(l.get("cases") or 0) for l in inv_lines)
-    ead_cases_sum = sum(int(l.get("cases") or 0) for l in ead_lines)
 
     if inv_cases_sum and ead_cases_sum is not None and inv_cases_sum != ead_cases_sum:
-        add("QUANTITY_INTEGRITY_CHECK", "TOTAL_CASES_MISMATCH", "FAIL",
-            invoice_sum_cases=inv_cases_sum, ead_sum_cases=ead_cases_sum)
+        issues.append({
+            "check_class": "QUANTITY_INTEGRITY_CHECK", "type": "TOTAL_CASES_MISMATCH", "severity": "FAIL",
+            "invoice_sum_cases": inv_cases_sum, "ead_sum_cases": ead_cases_sum,
+        })
 
     # Totals: EAD weight sanity
-    ead_gross_vals = [float(l.get("ead_gross_kg")) for l in ead_lines if l.get("ead_gross_kg") is not None]
-    ead_net_vals = [float(l.get("ead_net_kg")) for l in ead_lines if l.get("ead_net_kg") is not None]
-    ead_gross_sum = sum(ead_gross_vals) if ead_gross_vals else None
-    ead_net_sum = sum(ead_net_vals) if ead_net_vals else None
     if ead_gross_sum is not None and ead_net_sum is not None and ead_gross_sum <= ead_net_sum:
-        add("QUANTITY_INTEGRITY_CHECK", "TOTAL_GROSS_LE_NET", "WARN",
-            ead_gross_total=ead_gross_sum, ead_net_total=ead_net_sum)
+        issues.append({
+            "check_class": "QUANTITY_INTEGRITY_CHECK", "type": "TOTAL_GROSS_LE_NET", "severity": "WARN",
+            "ead_gross_total": ead_gross_sum, "ead_net_total": ead_net_sum,
+        })
 
     # invoice total colli vs sum(EAD Numero di colli) from packaging section
     inv_total_colli = inv_meta.get("invoice_total_colli")
@@ -760,16 +1228,24 @@ def validate_shipment(inv_ai, ead_ai, inv_lines, ead_lines, *, invoice_text: str
 
     if inv_total_colli is not None and ead_colli_sum is not None:
         if int(inv_total_colli) != int(ead_colli_sum):
-            add("QUANTITY_INTEGRITY_CHECK", "TOTAL_COLLI_MISMATCH", "FAIL",
-                invoice_total_colli=inv_total_colli, ead_packaging_colli_sum=ead_colli_sum)
+            issues.append({
+                "check_class": "QUANTITY_INTEGRITY_CHECK", "type": "TOTAL_COLLI_MISMATCH", "severity": "FAIL",
+                "invoice_total_colli": inv_total_colli, "ead_packaging_colli_sum": ead_colli_sum,
+            })
 
     if inv_gross_kg is not None and ead_gross_sum is not None:
         if abs(inv_gross_kg - ead_gross_sum) > 0:
-            add("COMPLETENESS_CHECK", "GROSS_KG_MISMATCH", "FAIL",inv_gross_kg=inv_gross_kg, ead_gross_sum=ead_gross_sum)
+            issues.append({
+                "check_class": "COMPLETENESS_CHECK", "type": "GROSS_KG_MISMATCH", "severity": "FAIL",
+                "inv_gross_kg": inv_gross_kg, "ead_gross_sum": ead_gross_sum,
+            })
 
     if inv_net_kg is not None and ead_net_sum is not None:
         if abs(inv_net_kg - ead_net_sum) > 0:
-            add("COMPLETENESS_CHECK", "NET_KG_MISMATCH", "FAIL",inv_net_kg =inv_net_kg,ead_net_sum = ead_net_sum)
+            issues.append({
+                "check_class": "COMPLETENESS_CHECK", "type": "NET_KG_MISMATCH", "severity": "FAIL",
+                "inv_net_kg": inv_net_kg, "ead_net_sum": ead_net_sum,
+            })
 
     # ------------------------------------------------------------
     # cross-doc weight consistency (Invoice totals vs EAD sums)
@@ -780,122 +1256,174 @@ def validate_shipment(inv_ai, ead_ai, inv_lines, ead_lines, *, invoice_text: str
     # Gross weight comparison
     if inv_gross is not None and ead_gross_sum is not None:
         if not close_enough(inv_gross, ead_gross_sum, abs_tol=3.0, rel_tol=0.01):
-            add(
-                "QUANTITY_INTEGRITY_CHECK",
-                "GROSS_KG_INVOICE_VS_EAD_MISMATCH",
-                "WARN",  # could be FAIL if you want strict
-                invoice_gross_kg=inv_gross,
-                ead_gross_kg_sum=ead_gross_sum,
-                diff=abs(float(inv_gross) - float(ead_gross_sum)),
-            )
+            issues.append({
+                "check_class": "QUANTITY_INTEGRITY_CHECK", "type": "GROSS_KG_INVOICE_VS_EAD_MISMATCH",
+                "severity": "WARN",  # could be FAIL if you want strict
+                "invoice_gross_kg": inv_gross, "ead_gross_kg_sum": ead_gross_sum,
+                "diff": abs(float(inv_gross) - float(ead_gross_sum)),
+            })
     elif inv_gross is not None and ead_gross_sum is None:
-        add("COMPLETENESS_CHECK", "MISSING_EAD_GROSS_TOTAL", "WARN", invoice_gross_kg=inv_gross)
+        issues.append({
+            "check_class": "COMPLETENESS_CHECK", "type": "MISSING_EAD_GROSS_TOTAL", "severity": "WARN",
+            "invoice_gross_kg": inv_gross,
+        })
     elif inv_gross is None and ead_gross_sum is not None:
-        add("COMPLETENESS_CHECK", "MISSING_INVOICE_GROSS_KG", "WARN", ead_gross_kg_sum=ead_gross_sum)
+        issues.append({
+            "check_class": "COMPLETENESS_CHECK", "type": "MISSING_INVOICE_GROSS_KG", "severity": "WARN",
+            "ead_gross_kg_sum": ead_gross_sum,
+        })
 
     # Net weight comparison
     if inv_net is not None and ead_net_sum is not None:
         if not close_enough(inv_net, ead_net_sum, abs_tol=3.0, rel_tol=0.01):
-            add(
-                "QUANTITY_INTEGRITY_CHECK",
-                "NET_KG_INVOICE_VS_EAD_MISMATCH",
-                "WARN",
-                invoice_net_kg=inv_net,
-                ead_net_kg_sum=ead_net_sum,
-                diff=abs(float(inv_net) - float(ead_net_sum)),
-            )
+            issues.append({
+                "check_class": "QUANTITY_INTEGRITY_CHECK", "type": "NET_KG_INVOICE_VS_EAD_MISMATCH", "severity": "WARN",
+                "invoice_net_kg": inv_net, "ead_net_kg_sum": ead_net_sum,
+                "diff": abs(float(inv_net) - float(ead_net_sum)),
+            })
     elif inv_net is not None and ead_net_sum is None:
-        add("COMPLETENESS_CHECK", "MISSING_EAD_NET_TOTAL", "WARN", invoice_net_kg=inv_net)
+        issues.append({
+            "check_class": "COMPLETENESS_CHECK", "type": "MISSING_EAD_NET_TOTAL", "severity": "WARN",
+            "invoice_net_kg": inv_net,
+        })
     elif inv_net is None and ead_net_sum is not None:
-        add("COMPLETENESS_CHECK", "MISSING_INVOICE_NET_KG", "WARN", ead_net_kg_sum=ead_net_sum)
+        issues.append({
+            "check_class": "COMPLETENESS_CHECK", "type": "MISSING_INVOICE_NET_KG", "severity": "WARN",
+            "ead_net_kg_sum": ead_net_sum,
+        })
 
     # NEW: packaging sanity: total bottles / total colli ≈ bottles_per_case mode
-    total_bottles = 0
-    bpcs = []
-    for l in inv_lines:
-        c = l.get("cases")
-        bpc = l.get("bottles_per_case")
-        if bpc is not None:
-            try:
-                bpcs.append(int(bpc))
-            except Exception:
-                pass
-        if c is not None and bpc is not None:
-            try:
-                total_bottles += int(c) * int(bpc)
-            except Exception:
-                pass
-
     if inv_total_colli is not None and inv_total_colli > 0 and total_bottles > 0:
         bottles_per_carton = total_bottles / float(inv_total_colli)
 
-        if bpcs:
-            mode_bpc = Counter(bpcs).most_common(1)[0][0]
+        if bpc_counts:
+            mode_bpc = max(bpc_counts, key=bpc_counts.get)
             if abs(bottles_per_carton - mode_bpc) > 0.25:
-                add("QUANTITY_INTEGRITY_CHECK", "PACKAGING_UNIT_MISMATCH", "FAIL",
-                    total_bottles=total_bottles,
-                    invoice_total_colli=inv_total_colli,
-                    bottles_per_carton=bottles_per_carton,
-                    mode_bottles_per_case=mode_bpc)
+                issues.append({
+                    "check_class": "QUANTITY_INTEGRITY_CHECK", "type": "PACKAGING_UNIT_MISMATCH", "severity": "FAIL",
+                    "total_bottles": total_bottles, "invoice_total_colli": inv_total_colli,
+                    "bottles_per_carton": bottles_per_carton, "mode_bottles_per_case": mode_bpc,
+                })
         else:
-            add("QUANTITY_INTEGRITY_CHECK", "PACKAGING_UNIT_UNCHECKED", "WARN",
-                reason="No bottles_per_case extracted from invoice rows")
+            issues.append({
+                "check_class": "QUANTITY_INTEGRITY_CHECK", "type": "PACKAGING_UNIT_UNCHECKED", "severity": "WARN",
+                "reason": "No bottles_per_case extracted from invoice rows",
+            })
 
     return issues
 
 
+# build_output_df columns, in order
+OUTPUT_COLUMNS = [
+    "DESCRIPTION",
+    "DENOMINAZIONE DI ORIGINE",
+    "CUSTOMS COMMODITY CODE",
+    "% ALCOHOL",
+    "CASES / COLLI",
+    "BOTTLES PER CASE",
+    "BOTTLE SIZE (L)",
+    "TOTAL LITERS (calc)",
+    "EAD LITERS",
+    "GROSS WEIGHT (KG)",
+    "NET WEIGHT (KG)",
+    "INVOICE VALUE (EUR)",
+    "LOT",
+    "EAD PROGRESSIVO",
+    "MATCH_SCORE",
+]
+
+
 def build_output_df(matches):
+    import pandas as pd
+
+    # One tuple per match (values in OUTPUT_COLUMNS order), transposed into
+    # columns at the end: pandas builds a frame from a dict of columns
+    # faster than from a list of row dicts.
     rows = []
     for inv, ead, score in matches:
-        rows.append({
+        rows.append((
             # Prefer EAD description if present (designazione commerciale is the cleanest)
-            "DESCRIPTION": (
-                (ead.get("designazione_commerciale") if ead else None)
-            ),
+            ead.get("designazione_commerciale") if ead else None,
 
-            "DENOMINAZIONE DI ORIGINE": (ead.get("denominazione_origine") if ead else None),
+            ead.get("denominazione_origine") if ead else None,
 
             # EAD first
-            "CUSTOMS COMMODITY CODE": (ead.get("cn_code") if ead else None) or inv.get("cn_code"),
+            (ead.get("cn_code") if ead else None) or inv.get("cn_code"),
 
             # EAD first
-            "% ALCOHOL": (
-                (ead.get("abv_percent") if ead else None)
+            (
+                ead.get("abv_percent")
                 if (ead and ead.get("abv_percent") is not None)
                 else inv.get("abv_percent")
             ),
 
             # EAD first
-            "CASES / COLLI": (ead.get("cases") if ead else None) or inv.get("cases"),
+            (ead.get("cases") if ead else None) or inv.get("cases"),
 
             # Packaging detail usually only invoice has
-            "BOTTLES PER CASE": inv.get("bottles_per_case"),
-            "BOTTLE SIZE (L)": normalize_bottle_liters(inv.get("bottle_liters")),
+            inv.get("bottles_per_case"),
+            (
+                inv["_bottle_liters_norm"] if "_bottle_liters_norm" in inv
+                else normalize_bottle_liters(inv.get("bottle_liters"))
+            ),
 
-            "TOTAL LITERS (calc)": liters_from_invoice(inv),
-            "EAD LITERS": ead.get("ead_liters") if ead else None,
+            line_liters(inv),
+            ead.get("ead_liters") if ead else None,
 
-            "GROSS WEIGHT (KG)": ead.get("ead_gross_kg") if ead else None,
-            "NET WEIGHT (KG)": ead.get("ead_net_kg") if ead else None,
+            ead.get("ead_gross_kg") if ead else None,
+            ead.get("ead_net_kg") if ead else None,
 
             # This MUST come from invoice (EAD doesn't carry item value)
-            "INVOICE VALUE (EUR)": inv.get("invoice_value_eur"),
+            inv.get("invoice_value_eur"),
 
-            "LOT": inv.get("lot"),
-            "EAD PROGRESSIVO": ead.get("progressivo") if ead else None,
-            "MATCH_SCORE": score,
-        })
-    return pd.DataFrame(rows)
+            inv.get("lot"),
+            ead.get("progressivo") if ead else None,
+            score,
+        ))
+    # (no matches: no columns, as before)
+    return pd.DataFrame({name: list(col) for name, col in zip(OUTPUT_COLUMNS, zip(*rows))})
+
+
+# Sheet name of the CLI packing list (both writers)
+PACKING_LIST_SHEET = "packing_list"
+
+
+def _write_xlsx_streaming(df: pd.DataFrame, out_xlsx: Path) -> None:
+    """
+    xlsxwriter in constant_memory mode: each row is flushed to disk as soon
+    as the next one starts, so peak memory stays at about one row. Rows are
+    written here in order; df.to_excel emits cells column by column, which
+    constant_memory would silently drop.
+    """
+    import xlsxwriter
+
+    wb = xlsxwriter.Workbook(str(out_xlsx), {
+        "constant_memory": True,
+        "strings_to_formulas": False,
+        "strings_to_urls": False,
+    })
+    try:
+        ws = wb.add_worksheet(PACKING_LIST_SHEET)
+        ws.write_row(0, 0, [str(c) for c in df.columns])
+        for r, row in enumerate(df.itertuples(index=False, name=None), start=1):
+            # None / NaN -> blank cell, like to_excel
+            ws.write_row(r, 0, [None if v is None or v != v else v for v in row])
+    finally:
+        wb.close()
 
 
 def write_excel_or_csv(df: pd.DataFrame, out_xlsx: Path) -> tuple[Path, str]:
     """
-    Write Excel if openpyxl is available; else fallback to CSV.
+    Write Excel, streamed with xlsxwriter if installed, else via openpyxl;
+    fallback to CSV if neither works.
     Returns (written_path, message)
     """
     try:
-        import openpyxl  # noqa: F401
-        df.to_excel(out_xlsx, index=False)
+        try:
+            _write_xlsx_streaming(df, out_xlsx)
+        except ImportError:
+            import openpyxl  # noqa: F401
+            df.to_excel(out_xlsx, index=False, sheet_name=PACKING_LIST_SHEET)
         return out_xlsx, "xlsx"
     except Exception as e:
         out_csv = out_xlsx.with_suffix(".csv")
@@ -903,24 +1431,37 @@ def write_excel_or_csv(df: pd.DataFrame, out_xlsx: Path) -> tuple[Path, str]:
         return out_csv, f"csv (Excel write failed: {type(e).__name__}: {e})"
 
 
+def issues_json_bytes(issues) -> bytes:
+    """
+    issues as indented UTF-8 JSON. Uses orjson when installed (serializes
+    straight to bytes in C), else the stdlib json module.
+    """
+    if orjson is not None:
+        return orjson.dumps(issues, option=orjson.OPT_INDENT_2)
+    return json.dumps(issues, indent=2, ensure_ascii=False).encode("utf-8")
+
+
 # -----------------------------
 # Main
 # -----------------------------
-def main():
-    out_dir = Path("out")
-    out_dir.mkdir(exist_ok=True)
-
-    invoice_text = (out_dir / "invoice_text.txt").read_text()
-    ead_text = (out_dir / "ead_text.txt").read_text()
-
-    # SAFE prompts for AI
-    inv_safe = redact(invoice_text)
-    ead_safe = redact(ead_text)
-
-    # AI extraction
-    inv_ai = ai_extract_invoice(inv_safe)
-    ead_ai = ai_extract_ead(ead_safe)
-
+def read_text_file(path: Path) -> str:
+    """
+    Text of a stage1 output file (written as UTF-8), decoded straight from
+    an mmap of the file: no intermediate bytes copy of the whole dump.
+    Newlines are normalized like read_text() does.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            text = str(mm, "utf-8")
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+
+def write_job_outputs(out_dir: Path, invoice_text: str, ead_text: str, inv_ai, ead_ai) -> None:
+    """Steps 5-8 for one invoice/EAD pair: outputs go to out_dir."""
     # Normalize
     inv = normalize_invoice_rows(inv_ai)
     ead = normalize_ead_rows(ead_ai)
@@ -942,15 +1483,74 @@ def main():
     out_xlsx = out_dir / "packing_list.xlsx"
     written_path, mode = write_excel_or_csv(df, out_xlsx)
 
-    (out_dir / "issues.json").write_text(json.dumps(issues, indent=2, ensure_ascii=False))
+    (out_dir / "issues.json").write_bytes(issues_json_bytes(issues))
 
     print("✅ Wrote:", written_path, f"[{mode}]")
     print("✅ Wrote:", out_dir / "issues.json")
     print("Issues:", len(issues))
-    if issues:
-        for i in issues[:12]:
-            print("-", i["severity"], i["type"], i.get("invoice_desc", ""))
+    # The 12 most severe (FAILs first, in their original order), picked with
+    # a bounded heap instead of sorting every issue
+    for i in heapq.nlargest(12, issues, key=lambda i: SEVERITY_RANK.get(i["severity"], 0)):
+        print("-", i["severity"], i["type"], i.get("invoice_desc", ""))
+
+
+def main():
+    out_dir = Path("out")
+    out_dir.mkdir(exist_ok=True)
+
+    invoice_text = read_text_file(out_dir / "invoice_text.txt")
+    ead_text = read_text_file(out_dir / "ead_text.txt")
+
+    # SAFE prompts for AI
+    inv_safe = redact(invoice_text)
+    ead_safe = redact(ead_text)
+
+    # AI extraction (both requests in flight at once). A rerun on the same
+    # safe texts is answered from stage2b's on-disk response cache.
+    import stage2b_ai_extract_openai as s2b
+
+    inv_ai, ead_ai = s2b.ai_extract_pair(inv_safe, ead_safe)
+
+    write_job_outputs(out_dir, invoice_text, ead_text, inv_ai, ead_ai)
+
+
+def main_batch(jobs_dir: Path):
+    """
+    Every subdirectory of jobs_dir holding stage1's invoice_text.txt and
+    ead_text.txt is one job. All jobs are extracted through the Batch API
+    (one invoice and one EAD batch, up to 24h turnaround), then each job's
+    outputs are written into its own directory.
+    """
+    job_dirs = sorted(
+        d for d in jobs_dir.iterdir()
+        if (d / "invoice_text.txt").is_file() and (d / "ead_text.txt").is_file()
+    )
+    if not job_dirs:
+        print("No jobs (invoice_text.txt + ead_text.txt) under", jobs_dir)
+        return
+
+    texts = [(read_text_file(d / "invoice_text.txt"), read_text_file(d / "ead_text.txt")) for d in job_dirs]
+
+    import stage2b_ai_extract_openai as s2b
+
+    inv_ais, ead_ais = s2b.ai_extract_pair_batch(
+        [redact(inv_text) for inv_text, _ in texts],
+        [redact(ead_text) for _, ead_text in texts],
+    )
+
+    for d, (invoice_text, ead_text), inv_ai, ead_ai in zip(job_dirs, texts, inv_ais, ead_ais):
+        print(f"== {d.name}")
+        if inv_ai is None or ead_ai is None:
+            print("❌ AI extraction failed in the batch; rerun to retry this job")
+            continue
+        write_job_outputs(d, invoice_text, ead_text, inv_ai, ead_ai)
 
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) == 3 and sys.argv[1] == "--batch":
+        main_batch(Path(sys.argv[2]))
+    elif len(sys.argv) == 1:
+        main()
+    else:
+        print("Usage: python stage3_match_validate_excel.py [--batch JOBS_DIR]")
+        sys.exit(1)
@@ -1,11 +1,11 @@
 from pathlib import Path
-from stage2b_ai_extract_openai import ai_extract_invoice, ai_extract_ead
+from stage2b_ai_extract_openai import ai_extract_pair
 
 inv_txt = Path("out/invoice_text.safe.txt").read_text()
 ead_txt = Path("out/ead_text.safe.txt").read_text()
 
-inv = ai_extract_invoice(inv_txt)
-ead = ai_extract_ead(ead_txt)
+# Both extractions in flight at once
+inv, ead = ai_extract_pair(inv_txt, ead_txt)
 
 print("Invoice rows:", len(inv.rows))
 print("EAD rows:", len(ead.rows))
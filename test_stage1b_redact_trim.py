@@ -0,0 +1,15 @@
+from stage1b_redact_trim import compact_text
+
+
+def test_compact_text_keeps_repeated_product_rows():
+    row = "Item A 6 x 0.75 12.00"
+    assert compact_text("\n".join([row, row, row])) == "\n".join([row, row, row])
+
+
+def test_compact_text_keeps_rows_separated_by_rule_line():
+    assert compact_text("A\n-----\nA") == "A\nA"
+    assert compact_text("A\n\n=====\n\nA") == "A\n\nA"
+
+
+def test_compact_text_collapses_blank_runs_and_drops_rules():
+    assert compact_text("Header  \n\n\n\n____\nRow 1\n\n\nRow 2") == "Header\n\nRow 1\n\nRow 2"